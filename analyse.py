@@ -1,8 +1,14 @@
 import typing
+from contextlib import nullcontext
+from copy import copy
 
 import numpy as np
 import scipy.optimize
-from scipy.optimize import milp, LinearConstraint, Bounds
+from scipy.optimize import linprog, milp, LinearConstraint, Bounds
+
+import metrics
+from highs_log import Progress, stream_progress
+from presolve import presolve
 
 min_air = 500
 max_res = 40             # Actually 80 but let's be safe
@@ -13,6 +19,47 @@ max_blocks = max_height*max_area
 rate_units = 20          # rates are in resource per 20s
 
 
+class Params(typing.NamedTuple):
+    # The challenge's limits, defaulting to the values above
+    min_air: float = min_air
+    max_res: float = max_res
+    init_money: float = init_money
+    max_area: int = max_area
+    max_height: int = max_height
+    rate_units: float = rate_units
+
+    @property
+    def max_blocks(self) -> int:
+        return self.max_height*self.max_area
+
+
+class SolverOptions(typing.NamedTuple):
+    time_limit: float | None = None   # Seconds; the best solution found so far is returned at the limit
+    mip_rel_gap: float | None = None  # Stop once the incumbent is this close to the bound
+    presolve: bool = True             # HiGHS's own presolve, as opposed to presolve.py
+    integral: bool = False            # Whole block counts
+
+    def milp_options(self) -> dict[str, typing.Any]:
+        options = {'presolve': self.presolve}
+        if self.time_limit is not None:
+            options['time_limit'] = self.time_limit
+        if self.mip_rel_gap is not None:
+            options['mip_rel_gap'] = self.mip_rel_gap
+        return options
+
+
+def show_progress(p: Progress) -> None:
+    print('{:7.1f}s {:>8d} nodes {:6.2f}% explored  bound {:10.3f}  best {:10.3f}  gap {:7.2%}'.format(
+        p.seconds, p.nodes, p.explored, p.bound, p.incumbent, p.gap))
+
+
+class Simulation(typing.NamedTuple):
+    mandatory: np.ndarray    # Resource rates per second, as a column by resource
+    optional: np.ndarray
+    time: float              # Seconds until the fresh air minimum is reached
+    at_win: np.ndarray       # Resource counts at that time
+
+
 class Analyse:
     """
     nb=173 blocks, nr=78 resources
@@ -27,12 +74,14 @@ class Analyse:
     Block counts must not be negative: implied by default value of `bounds`
     """
 
+    @metrics.stage('build')
     def __init__(
         self,
         blocks: typing.Sequence[dict[str, typing.Any]],
         resources: typing.Sequence[dict[str, typing.Any]],
+        params: Params = Params(),
     ) -> None:
-        self.resources, self.blocks = resources, blocks
+        self.resources, self.blocks, self.params = resources, blocks, params
         self.res_inds = {r['alias']: i for i, r in enumerate(resources)}
         self.air_index = self.res_inds['FRESH AIR']
         self.wild_index = self.res_inds['WILDERNESS']
@@ -44,6 +93,18 @@ class Analyse:
         self.c = self._get_c()
         self.constraints = self._get_constraints()
 
+        if metrics.enabled:
+            metrics.count('matrix_nonzeros', sum(int(np.count_nonzero(con.A)) for con in self.constraints))
+
+    def with_params(self, **overrides: float) -> 'Analyse':
+        """
+        A copy with some of the limits changed, sharing the rate matrices rather than rebuilding them.
+        """
+        other = copy(self)
+        other.params = self.params._replace(**overrides)
+        other.constraints = other._get_constraints()
+        return other
+
     def _get_rates(self) -> tuple[np.ndarray, np.ndarray]:
         rates_no_opt = np.zeros((self.nr, self.nb))  # Resource rates without optionals
         rates_opt = np.zeros((self.nr, self.nb))     # Optional rates
@@ -75,20 +136,20 @@ class Analyse:
     def _get_constraints(self) -> tuple[LinearConstraint, ...]:
         # Only mandatory rates influence minima
         b_lower_rates = np.zeros(self.nr)         # Minimum rate for most resources is 0
-        b_lower_rates[self.air_index] = min_air        # Lowest fresh air allowable
-        b_lower_rates[self.money_index] = -init_money  # Lowest rate of money - left with nothing
+        b_lower_rates[self.air_index] = self.params.min_air        # Lowest fresh air allowable
+        b_lower_rates[self.money_index] = -self.params.init_money  # Lowest rate of money - left with nothing
         lower_rates_constraint = LinearConstraint(A=self.rates_no_opt, lb=b_lower_rates)
 
         a_upper_rates = self.rates_no_opt + self.rates_opt          # Allow opt inputs to help rate maxima
-        b_upper_rates = np.full(shape=self.nr, fill_value=max_res)  # Upper rate for most resources is 80
-        b_upper_rates[self.money_index] -= init_money               # Most amount of money left at end is 80
+        b_upper_rates = np.full(shape=self.nr, fill_value=self.params.max_res)  # Upper rate for most is 80
+        b_upper_rates[self.money_index] -= self.params.init_money  # Most amount of money left at end is 80
         # Neither fresh air nor wilderness have maxima
         a_upper_rates = np.delete(a_upper_rates, (self.air_index, self.wild_index), axis=0)
         b_upper_rates = np.delete(b_upper_rates, (self.air_index, self.wild_index), axis=0)
         upper_rates_constraint = LinearConstraint(A=a_upper_rates, ub=b_upper_rates)
 
         # The map is an 8x8 x 10 grid. As such, there is an upper bound on the block count.
-        upper_count_constraint = LinearConstraint(A=np.ones(self.nb), ub=max_blocks)
+        upper_count_constraint = LinearConstraint(A=np.ones(self.nb), ub=self.params.max_blocks)
 
         return lower_rates_constraint, upper_rates_constraint, upper_count_constraint
 
@@ -98,7 +159,7 @@ class Analyse:
 
         block_counts = res.x
         n_blocks = block_counts.sum()
-        norm_block_counts = block_counts * max_area/n_blocks
+        norm_block_counts = block_counts * self.params.max_area/n_blocks
         round_block_counts = np.around(norm_block_counts)
 
         print('Block count: optimized count, area-normalized, rounded:')
@@ -108,13 +169,32 @@ class Analyse:
                         if c > 0.01))
         print()
 
-        xr = np.array(round_block_counts, ndmin=2).T
-        nr = np.matmul(self.rates_no_opt, xr) / rate_units
-        oR = np.matmul(self.rates_opt, xr) / rate_units
-        time = min_air/nr[self.air_index]
+        sim = self.simulate(round_block_counts)
+
+        print('After normalizing and rounding,')
+        print('Resource production rate, mandatory/optional; count at win:')
+        print('{:15s} {:>8s} {:>8s} {:>8s}'.format('Resource', 'Mand', 'Opt', 'Win'))
+        print('\n'.join('{:15s} {:8.2f} {:8.2f} {:8.1f}'
+                        .format(self.resources[i]['alias'], *(v[0] for v in vals))
+                        for i, vals in enumerate(zip(sim.mandatory, sim.optional, sim.at_win))
+                        if any(abs(v[0]) >= 1e-3 for v in vals)))
+        print()
+
+        print('Number of blocks: %d' % round_block_counts.sum())
+        print('Time to win (s): %.1f' % sim.time)
+
+    def simulate(self, block_counts: np.ndarray) -> Simulation:
+        """
+        Resource rates of a build with the given count of each block, and how it stands once it has made
+        enough fresh air.
+        """
+        xr = np.array(block_counts, ndmin=2).T
+        nr = np.matmul(self.rates_no_opt, xr) / self.params.rate_units
+        oR = np.matmul(self.rates_opt, xr) / self.params.rate_units
+        time = self.params.min_air/nr[self.air_index, 0]
 
         init = np.zeros((self.nr, 1))
-        init[self.money_index] = init_money
+        init[self.money_index] = self.params.init_money
         # Final amounts won't go lower than zero if optional inputs drain them
         reff = []
         for n,o in zip(nr, oR):
@@ -127,28 +207,174 @@ class Analyse:
                 r = n
             reff.append(r)
         xwin = init + time*np.array(reff, ndmin=2).T
+        return Simulation(nr, oR, time, xwin)
 
-        print('After normalizing and rounding,')
-        print('Resource production rate, mandatory/optional; count at win:')
-        print('{:15s} {:>8s} {:>8s} {:>8s}'.format('Resource', 'Mand', 'Opt', 'Win'))
-        print('\n'.join('{:15s} {:8.2f} {:8.2f} {:8.1f}'
-                        .format(self.resources[i]['alias'], *(v[0] for v in vals))
-                        for i, vals in enumerate(zip(nr, oR, xwin))
-                        if any(abs(v[0]) >= 1e-3 for v in vals)))
-        print()
+    def _get_inequalities(self) -> tuple[np.ndarray, np.ndarray, list[tuple[str, str]]]:
+        """
+        The constraints as a single A_ub*x <= b_ub system, with a (kind, name) label per row; lower bounds
+        become negated rows
+        """
+        upper_res = np.delete(np.arange(self.nr), (self.air_index, self.wild_index))
+        names = {'min': [r['alias'] for r in self.resources],
+                 'max': [self.resources[i]['alias'] for i in upper_res],
+                 'count': ['blocks']}
 
-        print('Number of blocks: %d' % sum(xr))
-        print('Time to win (s): %.1f' % time)
+        a_rows, b_rows, labels = [], [], []
+        for kind, con in zip(('min', 'max', 'count'), self.constraints):
+            a = np.atleast_2d(con.A)
+            lb = np.broadcast_to(con.lb, a.shape[0])
+            ub = np.broadcast_to(con.ub, a.shape[0])
+            for i, name in enumerate(names[kind]):
+                if np.isfinite(lb[i]):
+                    a_rows.append(-a[i])
+                    b_rows.append(-lb[i])
+                    labels.append(('min' if kind != 'count' else kind, name))
+                if np.isfinite(ub[i]):
+                    a_rows.append(a[i])
+                    b_rows.append(ub[i])
+                    labels.append(('max' if kind != 'count' else kind, name))
+        return np.array(a_rows), np.array(b_rows), labels
 
-    def analyse(self) -> None:
-        print('Calculating a solution for the zero-footprint challenge...')
+    @staticmethod
+    def _rhs_ranging(
+        a_ub: np.ndarray, b_ub: np.ndarray, x: np.ndarray, slack: np.ndarray,
+        duals: np.ndarray, reduced: np.ndarray, tol: float = 1e-7,
+    ) -> dict[int, tuple[float, float]] | None:
+        """
+        For each priced row, the interval of its right-hand side over which the optimal basis - and so
+        its shadow price - stays the same. linprog does not return its basis, so one is rebuilt from the
+        solution: nonzero block counts and priced rows first, then - for a degenerate solution - zero
+        counts with zero reduced cost, or tight unpriced rows, until the basis is square.
+        """
+        cols = list(np.flatnonzero(x > tol))
+        rows = list(np.flatnonzero((slack <= tol) & (np.abs(duals) > tol)))
+        spare_cols = np.flatnonzero((x <= tol) & (np.abs(reduced) <= tol))
+        spare_rows = np.flatnonzero((slack <= tol) & (np.abs(duals) <= tol))
 
-        res = milp(
-            c=self.c,
-            # integrality=True,
-            bounds=Bounds(lb=0),
-            constraints=self.constraints,
-        )
+        def rank(r, c):
+            return np.linalg.matrix_rank(a_ub[np.ix_(r, c)]) if r and c else 0
+
+        for j in spare_cols:
+            if len(cols) >= len(rows):
+                break
+            if rank(rows, cols + [j]) > rank(rows, cols):
+                cols.append(j)
+        for i in spare_rows:
+            if len(rows) >= len(cols):
+                break
+            if rank(rows + [i], cols) > rank(rows, cols):
+                rows.append(i)
+        if len(rows) != len(cols) or rank(rows, cols) < len(rows):
+            return None
+
+        b_inv = np.linalg.inv(a_ub[np.ix_(rows, cols)])
+        others = np.setdiff1d(np.arange(len(b_ub)), rows)
+        values = np.concatenate((x[cols], slack[others]))
+        ranges = {}
+        for k, i in enumerate(rows):
+            dx = b_inv[:, k]  # Change of the basic block counts per unit increase of b_i
+            rates = np.concatenate((dx, -a_ub[np.ix_(others, cols)] @ dx))
+            falling, rising = rates < -tol, rates > tol
+            up = np.min(np.maximum(values[falling], 0) / -rates[falling], initial=np.inf)
+            down = np.min(np.maximum(values[rising], 0) / rates[rising], initial=np.inf)
+            ranges[i] = b_ub[i] - down, b_ub[i] + up
+        return ranges
+
+    def sensitivity(self) -> None:
+        print('Calculating shadow prices for the zero-footprint challenge...')
+
+        a_ub, b_ub, labels = self._get_inequalities()
+        with metrics.stage('solve'):
+            res = linprog(c=self.c, A_ub=a_ub, b_ub=b_ub, bounds=(0, None), method='highs')
         if not res.success:
             raise ValueError(res.message)
         self._show(res)
+        print()
+
+        slack, duals = res.ineqlin.residual, res.ineqlin.marginals
+        ranges = self._rhs_ranging(a_ub, b_ub, res.x, slack, duals, res.lower.marginals)
+        priced = (slack <= 1e-7) & (np.abs(duals) > 1e-7)
+
+        # Report everything in terms of the bounds as they are set above, so lower bounds flip sign back
+        print('Binding constraints: objective change per unit increase of the bound, and the bound range')
+        print('over which that price holds:')
+        print('{:5s} {:15s} {:>9s} {:>9s} {:>10s} {:>10s}'.format('', 'Resource', 'Bound', 'Price', 'From', 'To'))
+        for i, ((kind, name), price) in enumerate(zip(labels, duals)):
+            if not priced[i]:
+                continue
+            sign = -1 if kind == 'min' else 1
+            if ranges is None:
+                low, high = np.nan, np.nan
+            else:
+                low, high = sorted(sign*v for v in ranges[i])
+            print('{:5s} {:15s} {:9.2f} {:9.4f} {:10.2f} {:10.2f}'.format(
+                kind, name, sign*b_ub[i], sign*price, low, high))
+        if ranges is None:
+            print('(The solution is degenerate, so bound ranges are not available.)')
+        print()
+
+        print('Slack of the constraints that do not bind:')
+        print('{:5s} {:15s} {:>9s} {:>9s}'.format('', 'Resource', 'Bound', 'Slack'))
+        print('\n'.join('{:5s} {:15s} {:9.2f} {:9.2f}'.format(kind, name, (-1 if kind == 'min' else 1)*b, s)
+                        for (kind, name), b, s in zip(labels, b_ub, slack)
+                        if 1e-7 < s and np.isfinite(b)))
+        print()
+
+        print('Unused blocks: objective cost reduction needed before each would be used:')
+        print('{:20s} {:>9s}'.format('Block', 'Reduced'))
+        reduced = res.lower.marginals
+        print('\n'.join('{:20s} {:9.4f}'.format(self.blocks[i]['toolTipHeader'], reduced[i])
+                        for i in np.argsort(reduced)
+                        if res.x[i] <= 1e-7))
+
+    def solve(
+        self,
+        reduce: bool = False,
+        verbose: bool = True,
+        options: SolverOptions = SolverOptions(),
+        progress: typing.Callable[[Progress], None] | None = None,
+    ) -> scipy.optimize.OptimizeResult:
+        """
+        Solve for the block counts, with res.x covering every block even when presolved. If a limit
+        stops the solver after it has found a solution, that solution is returned with res.mip_gap
+        giving its distance from the bound. `progress` is called with each row of the solver's log.
+        """
+        c, constraints = self.c, self.constraints
+        if reduce:
+            with metrics.stage('presolve'):
+                reduction = presolve(self.c, self.constraints)
+            c, constraints = reduction.c, reduction.constraints
+            metrics.count('presolve_unsupplied', len(reduction.unsupplied))
+            metrics.count('presolve_dominated', len(reduction.dominated))
+            if verbose:
+                print('Presolve removed %d blocks lacking a supply of their inputs and %d dominated blocks; '
+                      '%d of %d remain.' % (len(reduction.unsupplied), len(reduction.dominated),
+                                            len(reduction.kept), self.nb))
+
+        milp_options = options.milp_options()
+        milp_options['disp'] = progress is not None
+        with metrics.stage('solve'), stream_progress(progress) if progress else nullcontext():
+            res = milp(
+                c=c,
+                integrality=np.ones_like(c) if options.integral else None,
+                bounds=Bounds(lb=0),
+                constraints=constraints,
+                options=milp_options,
+            )
+        metrics.count('solver_nodes', int(res.get('mip_node_count') or 0))
+        if res.status == 1 and res.x is not None:
+            # Out of time or nodes, but with an incumbent
+            metrics.count('solver_limit_reached')
+            if verbose:
+                print('Stopped at the limit; the best solution found is within %.2f%% of the bound.'
+                      % (100*(res.mip_gap or 0)))
+        elif not res.success:
+            raise ValueError(res.message)
+        if reduce:
+            res.x = reduction.expand(res.x, self.nb)
+        return res
+
+    def analyse(self, reduce: bool = False, options: SolverOptions = SolverOptions(),
+                progress: bool = False) -> None:
+        print('Calculating a solution for the zero-footprint challenge...')
+        self._show(self.solve(reduce, options=options, progress=show_progress if progress else None))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+import typing
+from contextlib import redirect_stdout
+from copy import deepcopy
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from analyse import Analyse
+from main import analysis_fields, trim
+from synth_assets import write_game_dir
+from snapshot import load_game_data
+from unity_asset_dir import asset_files, get_dbs
+from unity_unpack import unpack_dbs
+
+# Pipeline benchmarks over synthetic game data
+#
+# Each stage is timed (best of several runs) and separately run once under tracemalloc for its peak
+# memory. Results are compared against a saved baseline, and any stage that is slower or larger than
+# the baseline by more than the tolerance fails the run. Light commands are also started as fresh
+# processes to track their startup time, and fail if they import any of the heavy modules. Listing and
+# exporting run against a fresh snapshot, as they usually would.
+
+heavy_modules = ('numpy', 'scipy', 'requests')
+
+
+class Stage(typing.NamedTuple):
+    name: str
+    unit: str
+    run: typing.Callable[[], typing.Any]
+    size: float
+
+
+def measure(stage: Stage, repeat: int) -> dict[str, float]:
+    best = float('inf')
+    with redirect_stdout(StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            stage.run()
+            best = min(best, time.perf_counter() - start)
+
+        tracemalloc.start()
+        stage.run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {'seconds': best, 'peak_kib': peak/1024, 'throughput': stage.size/best}
+
+
+def run_cli(*args: str) -> str:
+    # Returns the import-time log, which python writes to stderr
+    return subprocess.run((sys.executable, '-X', 'importtime', 'main.py') + args,
+                          check=True, capture_output=True, text=True).stderr
+
+
+def heavy_imports(*args: str) -> list[str]:
+    imported = {line.rsplit('|', 1)[-1].strip().split('.')[0]
+                for line in run_cli(*args).splitlines()
+                if line.startswith('import time:')}
+    return sorted(imported.intersection(heavy_modules))
+
+
+def light_commands(steam_prefix: Path) -> dict[str, tuple[str, ...]]:
+    game = ('--steam', str(steam_prefix), '--snapshot', str(steam_prefix / 'snapshot'))
+    return {'start_help': ('--help',),
+            'start_scan': game + ('scan',),
+            'start_unpack': game + ('unpack',),
+            'start_export': game + ('export', '--output', str(steam_prefix / 'blocks.csv'))}
+
+
+def get_stages(steam_prefix: Path, **gen_args) -> list[Stage]:
+    directory = write_game_dir(steam_prefix, **gen_args)
+    total_bytes = sum(fn.stat().st_size for fn in asset_files(directory))
+
+    with redirect_stdout(StringIO()):
+        load_game_data(steam_prefix, steam_prefix / 'snapshot')
+        block_db, resource_db = get_dbs(steam_prefix)
+        blocks, resources = unpack_dbs(block_db['data'], resource_db['data'])
+        trimmed = deepcopy(blocks)
+        trim(trimmed)
+
+    def run_trim():
+        trim(deepcopy(blocks))
+
+    def run_analyse():
+        Analyse(trimmed, resources).analyse()
+
+    return [Stage('scan', 'B/s', lambda: get_dbs(steam_prefix), total_bytes),
+            Stage('unpack', 'B/s', lambda: unpack_dbs(block_db['data'], resource_db['data']),
+                  len(block_db['data']) + len(resource_db['data'])),
+            Stage('unpack_fields', 'B/s',
+                  lambda: unpack_dbs(block_db['data'], resource_db['data'], analysis_fields),
+                  len(block_db['data']) + len(resource_db['data'])),
+            Stage('trim', 'blocks/s', run_trim, len(blocks)),
+            Stage('analyse', 'blocks/s', run_analyse, len(trimmed))] + [
+            Stage(name, 'runs/s', lambda args=args: run_cli(*args), 1)
+            for name, args in light_commands(steam_prefix).items()]
+
+
+def compare(results: dict, baseline: dict, time_tol: float, mem_tol: float,
+            time_floor: float = 0.005) -> list[str]:
+    # Stages that take a few milliseconds vary by more than any sensible relative tolerance, so a slowdown
+    # must also exceed `time_floor` seconds
+    failures = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if res['seconds'] > max(base['seconds'] * (1 + time_tol), base['seconds'] + time_floor):
+            failures.append('%s: %.3fs vs. baseline %.3fs' % (name, res['seconds'], base['seconds']))
+        if res['peak_kib'] > base['peak_kib'] * (1 + mem_tol):
+            failures.append('%s: %.0fkiB vs. baseline %.0fkiB' % (name, res['peak_kib'], base['peak_kib']))
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic game data.')
+    parser.add_argument('--blocks', type=int, default=240)
+    parser.add_argument('--resources', type=int, default=78)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--filler', type=int, default=2000, help='Filler objects per asset file')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', type=Path, default=Path('bench_baseline.json'))
+    parser.add_argument('--save', action='store_true', help='Save these results as the new baseline')
+    parser.add_argument('--time-tol', type=float, default=0.25)
+    parser.add_argument('--mem-tol', type=float, default=0.10)
+    parser.add_argument('--time-floor', type=float, default=0.005,
+                        help='Ignore slowdowns of less than this many seconds')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        stages = get_stages(Path(tmp), n_blocks=args.blocks, n_resources=args.resources,
+                            n_files=args.files, n_filler=args.filler)
+        print('{:13s} {:>9s} {:>10s} {:>14s}'.format('Stage', 'Time (s)', 'Peak kiB', 'Throughput'))
+        results = {}
+        for stage in stages:
+            res = results[stage.name] = measure(stage, args.repeat)
+            print('{:13s} {:9.4f} {:10.0f} {:>14s}'.format(
+                stage.name, res['seconds'], res['peak_kib'],
+                '%.3g %s' % (res['throughput'], stage.unit)))
+
+        failures = ['%s imports %s' % (' '.join(cmd), ', '.join(mods))
+                    for cmd in light_commands(Path(tmp)).values()
+                    for mods in (heavy_imports(*cmd),) if mods]
+
+    if args.save and not failures:
+        with args.baseline.open('w') as f:
+            json.dump(results, f, indent=2)
+        print('Saved baseline to', args.baseline)
+        return
+
+    try:
+        with args.baseline.open() as f:
+            failures += compare(results, json.load(f), args.time_tol, args.mem_tol, args.time_floor)
+    except FileNotFoundError:
+        print('No baseline at %s; run with --save to create one.' % args.baseline)
+
+    if failures:
+        print()
+        print('Regressions:')
+        print('\n'.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,19 @@
+import functools
+import sys
 from io import SEEK_CUR
 from struct import unpack
 
+__all__ = ('FieldType', 'Int', 'Float', 'Bool', 'String', 'AssetRef', 'GameObject', 'Enum', 'Vector3', 'List',
+           'intern_str', 'clears_strings')
+
+# Decoded strings by their encoded bytes, shared by every decoder. Block records repeat the same names
+# and translations many times over, so each is only decoded the first time it is seen. The strings are
+# also interned, so equal strings are the same object - within a database, across databases and across
+# game versions - and comparing them is cheap. The table itself is only needed while decoding, and is
+# cleared after each unpack so that it does not hold on to the raw bytes. Strings are decoded as they are
+# read rather than lazily from their slices: every consumer of the records wants a str.
+strings: dict[bytes, str] = {}
+
 
 def _read(f, n):
     data = f.read(n)
@@ -13,10 +26,35 @@ def _read_int(f):
     return unpack('i', _read(f, 4))[0]
 
 
+def intern_str(raw):
+    val = strings.get(raw)
+    if val is None:
+        val = strings[raw] = sys.intern(raw.decode('utf-8'))
+    return val
+
+
+def clears_strings(fn):
+    # Decorate a decoder so that the table is cleared when it is done, even if decoding fails
+    @functools.wraps(fn)
+    def clearing(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            strings.clear()
+    return clearing
+
+
 class FieldType:
     def read(self, f):
         raise NotImplementedError()
 
+    def skip(self, f):
+        # Move past a value without decoding it
+        if self.fixed:
+            f.seek(self.size, SEEK_CUR)
+        else:
+            self.read(f)
+
 
 class Int(FieldType):
     names = ('int',)
@@ -57,7 +95,7 @@ class String(FieldType):
         str_len = _read_int(f)
         if not str_len:
             return ''
-        val = _read(f, str_len).decode('utf-8')
+        val = intern_str(_read(f, str_len))
 
         # 4-byte alignment
         str_len &= 3
@@ -65,6 +103,10 @@ class String(FieldType):
             f.seek(4 - str_len, SEEK_CUR)
         return val
 
+    def skip(self, f):
+        str_len = _read_int(f)
+        f.seek(str_len + (-str_len & 3), SEEK_CUR)
+
 
 class AssetRef(FieldType):
     names = ('Sprite', 'Texture', 'Block', 'AudioClip', 'Material')
@@ -117,3 +159,13 @@ class List(FieldType):
         if list_len > 100:
             raise ValueError('Suspicious list length of %d' % list_len)
         return tuple(self.inner.read(f) for _ in range(list_len))
+
+    def skip(self, f):
+        list_len = _read_int(f)
+        if list_len > 100:
+            raise ValueError('Suspicious list length of %d' % list_len)
+        if self.inner.fixed:
+            f.seek(list_len * self.inner.size, SEEK_CUR)
+        else:
+            for _ in range(list_len):
+                self.inner.skip(f)
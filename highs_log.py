@@ -0,0 +1,88 @@
+import io
+import os
+import re
+import sys
+import threading
+import typing
+from contextlib import contextmanager, nullcontext, redirect_stdout
+
+# HiGHS progress
+#
+# scipy's milp takes no callback, but with disp on, HiGHS logs a row to the C-level stdout whenever the
+# incumbent or the bound improves, and every few seconds otherwise. While solving, that stdout is
+# redirected into a pipe, and a thread parses the rows into Progress tuples as they arrive. Python's
+# own sys.stdout keeps going to the console, so progress can simply be printed.
+
+
+class Progress(typing.NamedTuple):
+    source: str      # What found a new incumbent, per the HiGHS legend; blank for periodic rows
+    nodes: int
+    explored: float  # Percentage of the search tree
+    bound: float
+    incumbent: float
+    gap: float       # Relative; inf until both the bound and the incumbent are finite
+    seconds: float
+
+
+row_re = re.compile(r'^\s?(?P<source>[A-Za-z]?)\s+(?P<nodes>\d+)\s+\d+\s+\d+\s+(?P<explored>[\d.]+)%'
+                    r'\s+(?P<bound>\S+)\s+(?P<incumbent>\S+)\s+(?P<gap>\S+)\s.*\s(?P<seconds>[\d.]+)s\s*$')
+
+
+def _number(s: str) -> float:
+    try:
+        return float(s)
+    except ValueError:
+        return float('inf')
+
+
+def parse_row(line: str) -> Progress | None:
+    m = row_re.match(line)
+    if m is None:
+        return None
+    gap = m['gap']
+    return Progress(source=m['source'], nodes=int(m['nodes']), explored=float(m['explored']),
+                    bound=_number(m['bound']), incumbent=_number(m['incumbent']),
+                    gap=_number(gap[:-1])/100 if gap.endswith('%') else float('inf'),
+                    seconds=float(m['seconds']))
+
+
+@contextmanager
+def stream_progress(report: typing.Callable[[Progress], None]) -> typing.Iterator[None]:
+    """
+    Call `report` with each progress row that HiGHS logs within the context. The solve must be run with
+    disp on; the rest of its log is dropped.
+    """
+    try:
+        console_is_fd = sys.stdout.fileno() == 1
+    except (AttributeError, io.UnsupportedOperation):
+        console_is_fd = False
+
+    sys.stdout.flush()
+    saved = os.dup(1)
+    read_fd, write_fd = os.pipe()
+    os.dup2(write_fd, 1)
+    os.close(write_fd)
+
+    def pump() -> None:
+        with os.fdopen(read_fd, encoding='utf-8', errors='replace') as pipe:
+            for line in pipe:
+                row = parse_row(line)
+                if row is not None:
+                    report(row)
+
+    thread = threading.Thread(target=pump, daemon=True)
+    thread.start()
+    console = os.fdopen(os.dup(saved), 'w', buffering=1) if console_is_fd else None
+    try:
+        with redirect_stdout(console) if console else nullcontext():
+            try:
+                yield
+            finally:
+                # Restore fd 1 first: that closes the pipe's last write end, so the thread sees the end of
+                # the log, and it can still report the last rows to the console before that is closed
+                os.dup2(saved, 1)
+                os.close(saved)
+                thread.join()
+    finally:
+        if console:
+            console.close()
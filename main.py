@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
+import argparse
+import configparser
+import typing
 from pathlib import Path
 
-from analyse import Analyse
-from unity_asset_dir import get_dbs
-from unity_unpack import unpack_dbs
+import metrics
+
+# Command-line entry point. Heavy modules - numpy, scipy, requests and the decoders - are imported inside
+# the commands that use them so that the light commands start quickly.
+
+config_path = Path('blockhood.ini')
+
+# Block members that trim() and Analyse use; analysis-only runs need not decode the rest
+analysis_fields = ('toolTipHeader', 'category', 'inputs', 'outputs', 'optionalInputs',
+                   'inputsAmounts', 'outputsAmounts', 'optionalInputsAmounts',
+                   'connectUpperForward', 'connectUpperBack', 'connectUpperLeft', 'connectUpperRight')
 
 
 def hashable_res(block):
@@ -15,6 +26,7 @@ def hashable_res(block):
     return with_conns
 
 
+@metrics.stage('trim')
 def trim(blocks):
     old_len = len(blocks)
     while True:
@@ -46,11 +58,11 @@ def trim(blocks):
                                                               len_after_un - len(blocks)))
 
 
-def export_blocks(blocks):
+def export_blocks(blocks, fn: Path = Path('blocks.csv')):
     from csv import DictWriter
 
     keys = tuple(blocks[0].keys())
-    with open('blocks.csv', 'w', encoding='utf-8', newline='') as f:
+    with fn.open('w', encoding='utf-8', newline='') as f:
         w = DictWriter(f, keys)
         w.writeheader()
 
@@ -58,16 +70,143 @@ def export_blocks(blocks):
             w.writerow(b)
 
 
-def main() -> None:
-    block_db, resource_db = get_dbs(Path(r'D:\SteamLibrary'))
-    blocks, resources = unpack_dbs(block_db['data'], resource_db['data'])
+def steam_prefix(args: argparse.Namespace) -> Path:
+    if args.steam:
+        return args.steam
+    config = configparser.ConfigParser()
+    config.read(config_path, encoding='utf-8')
+    prefix = config.get('game', 'steam_prefix', fallback=None)
+    if prefix is None:
+        raise SystemExit('No game path: pass --steam or set steam_prefix in the [game] section of %s'
+                         % config_path)
+    return Path(prefix)
+
+
+def load(
+    args: argparse.Namespace,
+    fields: typing.Collection[str] | None = None,
+) -> tuple[list[dict[str, typing.Any]], list[dict[str, typing.Any]]]:
+    from snapshot import load_game_data
+    return load_game_data(steam_prefix(args), args.snapshot, args.version, fields)
+
+
+def cmd_scan(args: argparse.Namespace) -> None:
+    from unity_asset_dir import default_version, get_dbs
+    get_dbs(steam_prefix(args), args.version or default_version)
+
+
+def cmd_unpack(args: argparse.Namespace) -> None:
+    blocks, resources = load(args)
+    if args.resources:
+        print('\n'.join(r['alias'] for r in resources))
+    else:
+        print('\n'.join('{:25s} {}'.format(b['toolTipHeader'], b['category']) for b in blocks))
+
+
+def cmd_export(args: argparse.Namespace) -> None:
+    blocks, resources = load(args)
+    export_blocks(blocks, args.output)
+    print('Exported %d blocks to %s' % (len(blocks), args.output))
 
-    # export_blocks(blocks)
 
+def cmd_analyse(args: argparse.Namespace) -> None:
+    blocks, resources = load(args, analysis_fields)
     trim(blocks)
     print()
 
-    Analyse(blocks, resources).analyse()
+    from analyse import Analyse, SolverOptions
+    analysis = Analyse(blocks, resources)
+    if args.sensitivity:
+        analysis.sensitivity()
+    else:
+        options = SolverOptions(time_limit=args.time_limit, mip_rel_gap=args.gap,
+                                presolve=not args.no_solver_presolve, integral=args.integral)
+        analysis.analyse(reduce=args.presolve, options=options, progress=args.progress)
+
+
+def cmd_diff(args: argparse.Namespace) -> None:
+    from snapshot import load_game_data
+    from unity_asset_dir import installed_versions
+    from versions import BlockStore, pointer_fields, show
+
+    prefix = steam_prefix(args)
+    store = BlockStore(ignore=() if args.pointers else pointer_fields())
+    for version in args.versions or installed_versions(prefix):
+        blocks, resources = load_game_data(prefix, args.snapshot, version)
+        store.add_version(version, blocks)
+
+    print('%d versions, %d distinct block records' % (len(store.versions), len(store.blocks)))
+    print()
+    for diff in store.history():
+        show(diff, store)
+
+
+def cmd_serve(args: argparse.Namespace) -> None:
+    from service import Model, serve
+    serve(Model(steam_prefix(args), args.snapshot, args.version), args.host, args.port)
+
+
+def cmd_upload(args: argparse.Namespace) -> None:
+    import upload
+    upload.main(steam_prefix(args), args.snapshot, args.version)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Block'Hood analytics.")
+    parser.add_argument('--steam', type=Path, metavar='PREFIX',
+                        help='Steam library directory; defaults to steam_prefix in %s' % config_path)
+    parser.add_argument('--version', help='Game build, as in the name of its data directory')
+    parser.add_argument('--snapshot', type=Path, default=Path('snapshot'),
+                        help='Directory of decoded data snapshots, one per game version')
+    parser.add_argument('--metrics', type=Path, metavar='REPORT',
+                        help='Write per-stage timings, peak memory and counters to this JSON file')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('scan', help='Find the game databases').set_defaults(run=cmd_scan)
+
+    sub = commands.add_parser('unpack', help='Decode the game databases and list their contents')
+    sub.add_argument('--resources', action='store_true', help='List resources instead of blocks')
+    sub.set_defaults(run=cmd_unpack)
+
+    sub = commands.add_parser('export', help='Export the decoded blocks to CSV')
+    sub.add_argument('--output', type=Path, default=Path('blocks.csv'))
+    sub.set_defaults(run=cmd_export)
+
+    sub = commands.add_parser('analyse', help='Solve the zero-footprint challenge')
+    sub.add_argument('--sensitivity', action='store_true',
+                     help='Also report shadow prices, slacks, bound ranges and reduced costs')
+    sub.add_argument('--presolve', action='store_true',
+                     help='Remove unusable and dominated blocks first; often costs more than it saves')
+    sub.add_argument('--integral', action='store_true', help='Only allow whole block counts')
+    sub.add_argument('--time-limit', type=float, metavar='SECONDS',
+                     help='Stop the solver after this long and keep the best solution found')
+    sub.add_argument('--gap', type=float, help='Stop once within this relative gap of the bound')
+    sub.add_argument('--no-solver-presolve', action='store_true', help="Turn off the solver's own presolve")
+    sub.add_argument('--progress', action='store_true',
+                     help='Show the bound and best solution as they improve')
+    sub.set_defaults(run=cmd_analyse)
+
+    sub = commands.add_parser('diff', help='Compare the block databases of several game versions')
+    sub.add_argument('versions', nargs='*', help='Versions in order, oldest first; defaults to all installed')
+    sub.add_argument('--pointers', action='store_true',
+                     help='Also compare asset pointers, whose path IDs change with every build')
+    sub.set_defaults(run=cmd_diff)
+
+    sub = commands.add_parser('serve', help='Keep the model loaded and answer queries over local HTTP')
+    sub.add_argument('--host', default='127.0.0.1')
+    sub.add_argument('--port', type=int, default=8137)
+    sub.set_defaults(run=cmd_serve)
+
+    commands.add_parser('upload', help='Update the wiki from the game databases').set_defaults(run=cmd_upload)
+
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
+
+    args.run(args)
+
+    if args.metrics:
+        metrics.write_report(args.metrics)
 
 
 if __name__ == '__main__':
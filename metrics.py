@@ -0,0 +1,65 @@
+import json
+import time
+import tracemalloc
+import typing
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+# Pipeline instrumentation
+#
+# Off by default, in which case stage() and count() return immediately. Once enabled, every stage records
+# its wall time and its peak traced memory, and counters accumulate until the report is written. Stages
+# may nest; a parent's peak includes those of its children.
+
+enabled = False
+stages: list[dict[str, typing.Any]] = []
+counters: Counter = Counter()
+_stack: list[dict[str, typing.Any]] = []
+
+
+def enable() -> None:
+    global enabled
+    enabled = True
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+@contextmanager
+def stage(name: str) -> typing.Iterator[None]:
+    if not enabled:
+        yield
+        return
+
+    current, peak = tracemalloc.get_traced_memory()
+    if _stack:
+        _stack[-1]['peak'] = max(_stack[-1]['peak'], peak)
+    tracemalloc.reset_peak()
+    frame = {'name': '/'.join([f['name'] for f in _stack] + [name]),
+             'start_kib': current/1024, 'peak': current}
+    _stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _stack.pop()
+        frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+        if _stack:
+            _stack[-1]['peak'] = max(_stack[-1]['peak'], frame['peak'])
+        stages.append({'name': frame['name'], 'seconds': elapsed,
+                       'start_kib': frame['start_kib'], 'peak_kib': frame.pop('peak')/1024})
+
+
+def count(name: str, n: int | float = 1) -> None:
+    if enabled:
+        counters[name] += n
+
+
+def report() -> dict[str, typing.Any]:
+    return {'stages': stages, 'counters': dict(counters)}
+
+
+def write_report(path: Path) -> None:
+    with path.open('w', encoding='utf-8') as f:
+        json.dump(report(), f, indent=2)
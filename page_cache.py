@@ -0,0 +1,60 @@
+import json
+import os
+import typing
+from pathlib import Path
+
+# Local cache of wiki pages, keyed by page ID and tagged with the revision ID they were fetched at.
+# Entries are stored in the same shape as the MediaWiki query API returns them, so that they can be
+# handed straight to Block.from_web.
+
+
+class PageCache:
+    version = 1
+
+    def __init__(self, path: Path = Path('.wikicache.json')) -> None:
+        self.path = path
+        self.pages: dict[str, dict[str, typing.Any]] = {}
+        self.listing: dict[str, int] = {}       # page ID to latest revision ID, from the current sync
+        self.checkpoint: dict[str, str] | None = None  # continue parameters of an interrupted listing
+
+        try:
+            with path.open(encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        if state.get('version') != self.version:
+            return
+        self.pages = state['pages']
+        self.listing = state['listing']
+        self.checkpoint = state['checkpoint']
+
+    def save(self) -> None:
+        state = {'version': self.version, 'pages': self.pages,
+                 'listing': self.listing, 'checkpoint': self.checkpoint}
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, self.path)  # Never leave a half-written cache behind
+
+    def revid(self, page_id: str) -> int | None:
+        page = self.pages.get(page_id)
+        if page is None:
+            return None
+        return page['revisions'][0]['revid']
+
+    def stale(self) -> list[str]:
+        return [page_id for page_id, revid in self.listing.items()
+                if self.revid(page_id) != revid]
+
+    def put(self, page: dict[str, typing.Any]) -> None:
+        self.pages[str(page['pageid'])] = page
+
+    def prune(self) -> int:
+        # Drop pages that have left the category since they were cached
+        gone = self.pages.keys() - self.listing.keys()
+        for page_id in gone:
+            del self.pages[page_id]
+        return len(gone)
+
+    def current(self) -> list[dict[str, typing.Any]]:
+        return [self.pages[page_id] for page_id in self.listing if page_id in self.pages]
@@ -0,0 +1,97 @@
+import typing
+
+import numpy as np
+from scipy.optimize import LinearConstraint
+
+# Presolve of the block-count program
+#
+# The constraint matrices are the resource-flow graph in matrix form: one row per resource, one column
+# per block, positive where the block produces the resource and negative where it consumes it. Two
+# reductions are applied, and both keep an optimum of the reduced program optimal for the full one, with
+# the removed blocks at a count of zero:
+#
+# - Unsupplied blocks. A row that must stay at or above a non-negative bound, with no remaining block
+#   producing into it, can only be met if none of its consumers is built. This is how blocks needing a
+#   resource that nothing else produces are dropped - along with, in turn, the blocks that only they
+#   supplied. Rows that may go negative, like money, never remove anything.
+# - Dominated blocks. A block is dominated by another that costs no more and is at least as good in
+#   every row: no less production where there is a lower bound, no more where there is an upper one.
+#   Swapping one for the other never breaks a constraint. Of identical blocks, the first is kept.
+
+
+class Reduction(typing.NamedTuple):
+    c: np.ndarray
+    constraints: tuple[LinearConstraint, ...]
+    kept: np.ndarray                  # Indices of the remaining blocks in the full program
+    unsupplied: list[int]             # Removed blocks, by reason
+    dominated: dict[int, int]         # Removed block to the block that dominates it
+
+    def expand(self, x: np.ndarray, n: int) -> np.ndarray:
+        """
+        Map a solution of the reduced program back onto all `n` blocks.
+        """
+        full = np.zeros(n)
+        full[self.kept] = x
+        return full
+
+
+def _rows(constraints: typing.Sequence[LinearConstraint]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    a = np.vstack([np.atleast_2d(con.A) for con in constraints])
+    lb = np.concatenate([np.broadcast_to(con.lb, np.atleast_2d(con.A).shape[0]) for con in constraints])
+    ub = np.concatenate([np.broadcast_to(con.ub, np.atleast_2d(con.A).shape[0]) for con in constraints])
+    return a, lb, ub
+
+
+def _unsupplied(a: np.ndarray, lb: np.ndarray, ub: np.ndarray, live: np.ndarray) -> np.ndarray:
+    # Columns forced to zero: consumers in a row that needs >= 0 and has no producer, and producers in a
+    # row that needs <= 0 and has no consumer
+    sub = a[:, live]
+    starved = (lb >= 0) & ~(sub > 0).any(axis=1)
+    flooded = (ub <= 0) & ~(sub < 0).any(axis=1)
+    forced = (sub[starved] < 0).any(axis=0) | (sub[flooded] > 0).any(axis=0)
+    return live[forced]
+
+
+def _dominated(a: np.ndarray, lb: np.ndarray, ub: np.ndarray, c: np.ndarray,
+               live: np.ndarray) -> dict[int, int]:
+    sub, cost = a[:, live], c[live]
+    lower, upper = sub[np.isfinite(lb)], sub[np.isfinite(ub)]
+    n = len(live)
+    order = np.arange(n)
+    chunk = max(1, 2**22 // (sub.size + 1))  # Columns compared at a time, bounding the (m, n, chunk) arrays
+    dominated = {}
+    for start in range(0, n, chunk):
+        j = slice(start, start + chunk)
+        # better[k, i]: block k is at least as good as block start+i in every row, and in the objective
+        better = ((lower[:, :, None] >= lower[:, None, j]).all(axis=0)
+                  & (upper[:, :, None] <= upper[:, None, j]).all(axis=0)
+                  & (cost[:, None] <= cost[None, j]))
+        same = (sub[:, :, None] == sub[:, None, j]).all(axis=0) & (cost[:, None] == cost[None, j])
+        # Of identical blocks the first is kept; this also stops a block from dominating itself, and two
+        # blocks from removing each other
+        better &= ~same | (order[:, None] < order[None, j])
+        found = better.any(axis=0)
+        for i, k in zip(np.flatnonzero(found), better.argmax(axis=0)[found]):
+            dominated[int(live[start + i])] = int(live[k])
+    return dominated
+
+
+def presolve(c: np.ndarray, constraints: typing.Sequence[LinearConstraint]) -> Reduction:
+    """
+    Reduce a program over non-negative block counts, minimizing c*x subject to `constraints`.
+    """
+    a, lb, ub = _rows(constraints)
+    live = np.arange(len(c))
+    unsupplied = []
+    while (forced := _unsupplied(a, lb, ub, live)).size:
+        unsupplied.extend(int(j) for j in forced)
+        live = np.setdiff1d(live, forced)
+
+    # One pass is enough. Removing blocks makes no other block dominated, and a dominated block's dominator
+    # supplies at least as much to every row with a lower bound, so no row loses its last supplier.
+    dominated = _dominated(a, lb, ub, c, live)
+    live = np.setdiff1d(live, list(dominated))
+
+    reduced = tuple(LinearConstraint(A=np.atleast_2d(con.A)[:, live], lb=con.lb, ub=con.ub)
+                    for con in constraints)
+    return Reduction(c[live], reduced, live, unsupplied, dominated)
@@ -0,0 +1,217 @@
+import json
+import math
+import time
+import traceback
+import typing
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+import numpy as np
+
+from analyse import Analyse, Params, SolverOptions
+from main import trim
+from snapshot import load_game_data, source_stamp
+from unity_asset_dir import asset_files, data_dir, default_version
+
+# Local analysis service
+#
+# Holds the decoded databases and the built Analyse model in memory and answers JSON queries over HTTP
+# on localhost, so that each question costs a solve or a lookup rather than a fresh process. Before each
+# request, the asset files are stat'ed; only if any has changed is the model reloaded.
+#
+#   GET  /status              block and resource counts, and when they were loaded
+#   GET  /blocks              names of all decoded blocks
+#   GET  /blocks/<name>       one decoded block
+#   GET  /resources           all resources
+#   POST /solve               {"params": {"min_air": 600, ...}, "presolve": false,
+#                              "options": {"time_limit": 2, "mip_rel_gap": 0.01, "integral": true}}
+#   POST /simulate            {"counts": {"<block name>": 3, ...}, "params": {...}}
+#
+# "params" override any of analyse.Params for that request only, and "options" are any of
+# analyse.SolverOptions. A solve stopped by its time limit returns its best solution and gap. Malformed
+# queries get a 400 and anything unexpected a 500, both with an "error" message.
+
+Record = dict[str, typing.Any]
+
+
+class RequestError(Exception):
+    def __init__(self, message: str, status: HTTPStatus = HTTPStatus.BAD_REQUEST) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def _object(value: typing.Any, what: str) -> Record:
+    if not isinstance(value, dict):
+        raise RequestError('%s must be a JSON object' % what)
+    return value
+
+
+def _numbers(values: typing.Any, what: str, nullable: bool = False) -> Record:
+    # JSON booleans pass too, which suits the on/off solver options. Python's json reads NaN and Infinity.
+    for name, value in _object(values, what).items():
+        if not ((isinstance(value, (int, float)) and math.isfinite(value)) or (nullable and value is None)):
+            raise RequestError('%s %r must be a finite number' % (what, name))
+    return values
+
+
+# Parameters that divide or scale the program, and so must be positive
+positive_params = ('max_area', 'max_height', 'rate_units')
+
+
+class Model:
+    def __init__(self, steam_prefix: Path, snapshot_root: Path, version: str | None = None) -> None:
+        self.steam_prefix, self.snapshot_root = steam_prefix, snapshot_root
+        self.version = version or default_version
+        self.reload()
+
+    def stamp(self) -> dict[str, list[int]]:
+        return source_stamp(asset_files(data_dir(self.steam_prefix, self.version)))
+
+    def reload(self) -> None:
+        self.sources = self.stamp()
+        blocks, self.resources = load_game_data(self.steam_prefix, self.snapshot_root, self.version)
+        self.blocks = {b['toolTipHeader']: b for b in blocks}
+        trim(blocks)
+        self.analysis = Analyse(blocks, self.resources)
+        self.block_inds = {b['toolTipHeader']: i for i, b in enumerate(blocks)}
+        self.loaded = time.time()
+
+    def refresh(self) -> None:
+        if self.stamp() != self.sources:
+            print('Asset files changed; reloading.')
+            self.reload()
+
+    def with_params(self, params: dict[str, float] | None) -> Analyse:
+        if not params:
+            return self.analysis
+        _numbers(params, 'params')
+        unknown = params.keys() - Params._fields
+        if unknown:
+            raise RequestError('Unknown parameters: %s' % ', '.join(sorted(unknown)))
+        for name in positive_params:
+            if name in params and params[name] <= 0:
+                raise RequestError('Parameter %s must be positive' % name)
+        return self.analysis.with_params(**params)
+
+    def status(self) -> Record:
+        return {'version': self.version, 'blocks': len(self.blocks), 'analysed_blocks': self.analysis.nb,
+                'resources': len(self.resources), 'loaded': self.loaded}
+
+    def block(self, name: str) -> Record:
+        try:
+            return self.blocks[name]
+        except KeyError:
+            raise RequestError('No block named %r' % name, HTTPStatus.NOT_FOUND)
+
+    def solve(self, query: Record) -> Record:
+        analysis = self.with_params(query.get('params'))
+        options = _numbers(query.get('options', {}), 'options', nullable=True)
+        unknown = options.keys() - SolverOptions._fields
+        if unknown:
+            raise RequestError('Unknown solver options: %s' % ', '.join(sorted(unknown)))
+        presolve = query.get('presolve', False)
+        if not isinstance(presolve, bool):
+            raise RequestError('presolve must be true or false')
+        start = time.perf_counter()
+        try:
+            res = analysis.solve(reduce=presolve, verbose=False,
+                                 options=SolverOptions(**options))
+        except ValueError as e:
+            raise RequestError(str(e))
+        return {'message': res.message, 'objective': float(res.fun), 'gap': res.get('mip_gap'),
+                'seconds': time.perf_counter() - start,
+                'counts': {b['toolTipHeader']: float(x)
+                           for b, x in zip(analysis.blocks, res.x) if x > 1e-6}}
+
+    def simulate(self, query: Record) -> Record:
+        analysis = self.with_params(query.get('params'))
+        counts = np.zeros(analysis.nb)
+        for name, count in _numbers(query.get('counts', {}), 'counts').items():
+            if name not in self.block_inds:
+                raise RequestError('No analysed block named %r' % name)
+            counts[self.block_inds[name]] = count
+        air = analysis.rates_no_opt[analysis.air_index] @ counts
+        if air <= 0:
+            raise RequestError('The build makes no fresh air, so it never wins')
+        sim = analysis.simulate(counts)
+        rates = zip(self.resources, sim.mandatory, sim.optional, sim.at_win)
+        return {'time': float(sim.time),
+                'resources': {r['alias']: {'mandatory': float(n[0]), 'optional': float(o[0]),
+                                           'at_win': float(w[0])}
+                              for r, n, o, w in rates}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: 'Server'
+
+    def reply(self, status: HTTPStatus, body: typing.Any) -> None:
+        data = json.dumps(body, allow_nan=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_query(self, route: typing.Callable[[str, Record], typing.Any], query: Record) -> None:
+        path = unquote(urlsplit(self.path).path).rstrip('/')
+        try:
+            self.server.model.refresh()
+            self.reply(HTTPStatus.OK, route(path, query))
+        except RequestError as e:
+            self.reply(e.status, {'error': str(e)})
+        except (TypeError, ValueError) as e:
+            self.reply(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            self.reply(HTTPStatus.INTERNAL_SERVER_ERROR, {'error': '%s: %s' % (type(e).__name__, e)})
+
+    def route_get(self, path: str, query: Record) -> typing.Any:
+        model = self.server.model
+        if path == '/status':
+            return model.status()
+        if path == '/blocks':
+            return sorted(model.blocks)
+        if path.startswith('/blocks/'):
+            return model.block(path[len('/blocks/'):])
+        if path == '/resources':
+            return model.resources
+        raise RequestError('No route for GET %s' % path, HTTPStatus.NOT_FOUND)
+
+    def route_post(self, path: str, query: Record) -> typing.Any:
+        if path == '/solve':
+            return self.server.model.solve(query)
+        if path == '/simulate':
+            return self.server.model.simulate(query)
+        raise RequestError('No route for POST %s' % path, HTTPStatus.NOT_FOUND)
+
+    def do_GET(self) -> None:
+        self.handle_query(self.route_get, {})
+
+    def do_POST(self) -> None:
+        size = int(self.headers.get('Content-Length') or 0)
+        try:
+            query = json.loads(self.rfile.read(size) or b'{}')
+        except ValueError as e:
+            self.reply(HTTPStatus.BAD_REQUEST, {'error': 'Bad JSON: %s' % e})
+            return
+        if not isinstance(query, dict):
+            self.reply(HTTPStatus.BAD_REQUEST, {'error': 'The body must be a JSON object'})
+            return
+        self.handle_query(self.route_post, query)
+
+
+class Server(HTTPServer):
+    def __init__(self, model: Model, host: str = '127.0.0.1', port: int = 8137) -> None:
+        super().__init__((host, port), Handler)
+        self.model = model
+
+
+def serve(model: Model, host: str = '127.0.0.1', port: int = 8137) -> None:
+    with Server(model, host, port) as server:
+        print('Serving on http://%s:%d/' % server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
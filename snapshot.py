@@ -0,0 +1,255 @@
+import ast
+import json
+import mmap
+import shutil
+import sys
+import typing
+from pathlib import Path
+from struct import unpack_from
+
+import metrics
+
+if typing.TYPE_CHECKING:
+    import numpy as np
+
+# Columnar snapshot of the decoded block and resource databases
+#
+# A snapshot is a directory holding meta.json and one uncompressed .npy file per column part, so that
+# every array can be memory-mapped on load, and a load reads only the columns it asks for, one at a time,
+# into the records. Scalars are stored as plain typed columns, strings as indices into a single UTF-8
+# string table, and tuples and dicts as ragged columns: an offsets array of length n+1 plus a flattened
+# values (and keys) column, which may itself be ragged. Each game version gets its own snapshot
+# directory. A snapshot decoded with only some block members is marked as projected, and only serves
+# loads that ask for a subset of those members.
+
+version = 2
+Record = dict[str, typing.Any]
+
+
+class StringTable:
+    def __init__(self) -> None:
+        self.index: dict[str, int] = {}
+
+    def add(self, s: str) -> int:
+        i = self.index.get(s)
+        if i is None:
+            i = self.index[s] = len(self.index)
+        return i
+
+    def arrays(self) -> dict[str, 'np.ndarray']:
+        import numpy as np
+        encoded = [s.encode('utf-8') for s in self.index]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return {'offsets': offsets, 'blob': blob}
+
+
+def _kind(values: list) -> str:
+    if all(isinstance(v, bool) for v in values):
+        return 'bool'
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return 'int'
+    if all(isinstance(v, float) for v in values):
+        return 'float'
+    if all(isinstance(v, str) for v in values):
+        return 'str'
+    if all(isinstance(v, tuple) for v in values):
+        return 'tuple'
+    if all(isinstance(v, dict) for v in values):
+        return 'dict'
+    raise TypeError('Cannot store mixed column of %s' % sorted({type(v).__name__ for v in values}))
+
+
+def _offsets(lengths: typing.Iterable[int], n: int) -> 'np.ndarray':
+    import numpy as np
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(lengths, dtype=np.int64, count=n), out=offsets[1:])
+    return offsets
+
+
+def _encode(values: list, strings: StringTable, name: str, arrays: dict[str, 'np.ndarray']) -> dict:
+    import numpy as np
+    kind = _kind(values)
+    if kind == 'bool':
+        arrays[name] = np.array(values, dtype=np.bool_)
+    elif kind == 'int':
+        arrays[name] = np.array(values, dtype=np.int64)
+    elif kind == 'float':
+        arrays[name] = np.array(values, dtype=np.float64)  # Single-precision source values are exact here
+    elif kind == 'str':
+        arrays[name] = np.fromiter((strings.add(v) for v in values), dtype=np.int32, count=len(values))
+    elif kind == 'tuple':
+        arrays[name + '.offsets'] = _offsets(map(len, values), len(values))
+        inner = [x for v in values for x in v]
+        return {'kind': kind, 'values': _encode(inner, strings, name + '.values', arrays)}
+    else:
+        arrays[name + '.offsets'] = _offsets(map(len, values), len(values))
+        keys = [k for v in values for k in v.keys()]
+        inner = [x for v in values for x in v.values()]
+        return {'kind': kind,
+                'keys': _encode(keys, strings, name + '.keys', arrays),
+                'values': _encode(inner, strings, name + '.values', arrays)}
+    return {'kind': kind}
+
+
+def _decode(desc: dict, strings: list[str], name: str,
+            arrays: typing.Callable[[str], memoryview]) -> list:
+    kind = desc['kind']
+    if kind == 'str':
+        return [strings[i] for i in arrays(name).tolist()]
+    if kind in ('bool', 'int', 'float'):
+        return arrays(name).tolist()
+
+    offsets = arrays(name + '.offsets').tolist()
+    inner = _decode(desc['values'], strings, name + '.values', arrays)
+    if kind == 'tuple':
+        return [tuple(inner[i:j]) for i, j in zip(offsets, offsets[1:])]
+    keys = _decode(desc['keys'], strings, name + '.keys', arrays)
+    return [dict(zip(keys[i:j], inner[i:j])) for i, j in zip(offsets, offsets[1:])]
+
+
+def _encode_table(records: typing.Sequence[Record], strings: StringTable, table: str,
+                  arrays: dict[str, 'np.ndarray']) -> dict:
+    names = tuple(records[0].keys()) if records else ()
+    for r in records:
+        if tuple(r.keys()) != names:
+            raise ValueError('Records in %s do not share one set of fields' % table)
+    columns = [{'name': n, **_encode([r[n] for r in records], strings, '%s.%s' % (table, n), arrays)}
+               for n in names]
+    return {'count': len(records), 'columns': columns}
+
+
+def source_stamp(files: typing.Iterable[Path]) -> dict[str, list[int]]:
+    return {fn.name: [fn.stat().st_size, fn.stat().st_mtime_ns] for fn in files}
+
+
+def save(path: Path, blocks: typing.Sequence[Record], resources: typing.Sequence[Record],
+         sources: dict[str, list[int]], projected: bool = False) -> None:
+    import numpy as np
+    strings = StringTable()
+    arrays: dict[str, 'np.ndarray'] = {}
+    meta = {'version': version,
+            'sources': sources,
+            'projected': projected,
+            'tables': {'blocks': _encode_table(blocks, strings, 'blocks', arrays),
+                       'resources': _encode_table(resources, strings, 'resources', arrays)}}
+    for part, arr in strings.arrays().items():
+        arrays['strings.' + part] = arr
+
+    # Write beside the old snapshot and swap, so that a reader never sees a partial one
+    tmp = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    for name, arr in arrays.items():
+        np.save(tmp / (name + '.npy'), arr, allow_pickle=False)
+    with (tmp / 'meta.json').open('w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    tmp.rename(path)
+
+
+# The dtypes that save() writes, as memoryview formats
+npy_formats = {'|b1': '?', '|u1': 'B', '<i4': 'i', '<i8': 'q', '<f8': 'd'}
+
+
+def _map_npy(fn: Path) -> memoryview:
+    # A one-dimensional .npy file as written by save(), mapped without numpy so that a command that only
+    # loads a snapshot need not import it
+    with fn.open('rb') as f:
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    if view[:6] != b'\x93NUMPY':
+        raise ValueError('%s is not a .npy file' % fn)
+    if view[6] == 1:  # Format version
+        header_len, start = unpack_from('<H', view, 8)[0], 10
+    else:
+        header_len, start = unpack_from('<I', view, 8)[0], 12
+    header = ast.literal_eval(bytes(view[start: start + header_len]).decode('latin1'))
+    if sys.byteorder != 'little' and header['descr'][0] == '<':
+        raise ValueError('Snapshots can only be read on little-endian machines')
+    return view[start + header_len:].cast(npy_formats[header['descr']])
+
+
+def _fresh_meta(path: Path, sources: dict[str, list[int]] | None) -> dict | None:
+    try:
+        with (path / 'meta.json').open(encoding='utf-8') as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta['version'] != version or (sources is not None and meta['sources'] != sources):
+        return None
+    return meta
+
+
+def load(path: Path, sources: dict[str, list[int]] | None = None,
+         fields: typing.Collection[str] | None = None) -> tuple[
+    list[Record],
+    list[Record],
+] | None:
+    """
+    Load a snapshot, or return None if there is none, it has a different format version, or - when
+    `sources` is given - it was made from different asset files. With `fields`, only those block
+    columns are loaded, and there must be a column for each; without, the snapshot must not be projected.
+    """
+    meta = _fresh_meta(path, sources)
+    if meta is None or (fields is None and meta['projected']):
+        return None
+    block_columns = meta['tables']['blocks']['columns']
+    if fields is not None:
+        if not set(fields).issubset(c['name'] for c in block_columns):
+            return None
+        meta['tables']['blocks']['columns'] = [c for c in block_columns if c['name'] in fields]
+
+    def arrays(name: str) -> memoryview:
+        return _map_npy(path / (name + '.npy'))
+
+    offsets = arrays('strings.offsets').tolist()
+    blob = arrays('strings.blob').tobytes()
+    strings = [sys.intern(blob[i:j].decode('utf-8')) for i, j in zip(offsets, offsets[1:])]
+
+    tables = []
+    for table in ('blocks', 'resources'):
+        desc = meta['tables'][table]
+        records = [{} for _ in range(desc['count'])]
+        for c in desc['columns']:
+            # Only this column is held as Python objects beside the records, and its arrays stay mapped
+            # until it is read
+            name = c['name']
+            for r, val in zip(records, _decode(c, strings, '%s.%s' % (table, name), arrays)):
+                r[name] = val
+        tables.append(records)
+    return tables[0], tables[1]
+
+
+def load_game_data(steam_prefix: Path, root: Path = Path('snapshot'), version: str | None = None,
+                   fields: typing.Collection[str] | None = None) -> tuple[
+    list[Record],
+    list[Record],
+]:
+    """
+    Blocks from a fresh snapshot or, failing that, decoded and snapshotted. With `fields`, blocks may
+    be decoded with only those members, and the snapshot will only serve later loads of the same or
+    fewer fields.
+    """
+    # Deferred so that a fresh snapshot never touches the asset decoders
+    from unity_asset_dir import asset_files, data_dir, default_version, get_dbs
+
+    version = version or default_version
+    path = root / version
+    sources = source_stamp(asset_files(data_dir(steam_prefix, version)))
+    with metrics.stage('load_snapshot'):
+        data = load(path, sources, fields)
+    if data is not None:
+        blocks, resources = data
+        print('Loaded snapshot: %d blocks, %d resources.' % (len(blocks), len(resources)))
+        print()
+        return blocks, resources
+
+    from unity_unpack import unpack_assets
+    block_db, resource_db = get_dbs(steam_prefix, version)
+    blocks, resources = unpack_assets(block_db, resource_db, fields)
+    # A fresh full snapshot that lacked a requested column is still worth more than this projection
+    existing = _fresh_meta(path, sources)
+    if fields is None or existing is None or existing['projected']:
+        save(path, blocks, resources, sources, projected=fields is not None)
+    return blocks, resources
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+import lzma
+import random
+from hashlib import md5
+import typing
+from pathlib import Path
+from struct import pack
+
+import unity_bundle as bundle
+from fieldtypes import *
+from unity_asset_dir import MONO_BEHAVIOUR, data_dir, default_version
+from unity_type_tree import ALIGN_FLAG, COMMON_FLAG, Node, common_strings, node_struct, primitives
+from unity_unpack import get_members
+
+# Synthetic game data
+#
+# Writes Unity 5.6.2f1 serialized files (format 17, StandaloneWindows64, no type trees) holding a
+# blockDB_current and a resourceDB MonoBehaviour laid out the way unity_unpack expects, plus filler
+# objects. With type trees, the files instead claim a later engine build and the databases are written
+# in declaration order, as described by their trees. Either kind can be packed into an LZ4 or LZMA
+# UnityFS bundle. Nothing here comes from the game; it exists so that the decoders and the analysis can
+# be exercised and benchmarked without a copy of it.
+
+TEXTURE_2D = 28
+block_id, resource_id = 21222, 21225
+agent_needle = 'oneAdjacentNeighbor'
+
+# Physical order of Block members within a record, as ranges of member names. The decoder locates the
+# ranges by searching backwards from the agent list, so the members that fill the gaps between them
+# must not contain long printable runs. Members not listed here trail the record in declaration order.
+block_layout = (('geometry', 'altTexture1'),
+                ('altTexture2', 'toolTipContent'),
+                ('callOnce', 'callOnce2'),                    # 8-byte gap before distanceToStreet
+                ('distanceToStreet', 'distanceToStreet'),
+                ('cantiliverAmmount', 'cantiliverAmmount'),  # 4-byte gap before inputs
+                ('inputs', 'optionalInputsAmounts'),
+                ('myAgents', 'myAgents'),
+                ('allAgentFunctionsString', 'needsAccessToProduce'),
+                ('blockToSwap', 'prevSynergy'))
+
+words = ('field', 'water', 'tower', 'garden', 'market', 'forest', 'solar', 'compost', 'clinic',
+         'school', 'bridge', 'farm', 'grove', 'plant', 'studio', 'depot', 'loft', 'pond')
+
+
+def encode(field_type: FieldType, val: typing.Any) -> bytes:
+    if isinstance(field_type, Bool):
+        return pack('i', int(val))
+    if isinstance(field_type, (Int, Enum)):
+        return pack('i', val)
+    if isinstance(field_type, Float):
+        return pack('f', val)
+    if isinstance(field_type, String):
+        raw = val.encode('utf-8')
+        return pack('i', len(raw)) + raw + bytes(-len(raw) & 3)
+    if isinstance(field_type, (AssetRef, GameObject, Vector3)):
+        fmt = 'f' if isinstance(field_type, Vector3) else 'I'
+        return pack(fmt * len(val), *val)
+    if isinstance(field_type, List):
+        return pack('i', len(val)) + b''.join(encode(field_type.inner, v) for v in val)
+    raise TypeError(field_type)
+
+
+def _text(rnd: random.Random, n_words: int) -> str:
+    return ' '.join(rnd.choice(words) for _ in range(n_words))
+
+
+def _value(rnd: random.Random, field_type: FieldType) -> typing.Any:
+    if isinstance(field_type, Bool):
+        return rnd.random() < 0.5
+    if isinstance(field_type, Int):
+        return rnd.randrange(100)
+    if isinstance(field_type, Enum):
+        return rnd.randrange(len(field_type.vals))
+    if isinstance(field_type, Float):
+        return rnd.randrange(16) / 4
+    if isinstance(field_type, String):
+        return _text(rnd, 2)
+    if isinstance(field_type, AssetRef):
+        return 0, rnd.randrange(1, 30000), 0
+    if isinstance(field_type, GameObject):
+        return 0, rnd.randrange(1, 30000), 0, 0, 0
+    if isinstance(field_type, Vector3):
+        return 0., 0., 0.
+    if isinstance(field_type, List):
+        return tuple(_value(rnd, field_type.inner) for _ in range(rnd.randrange(3)))
+    raise TypeError(field_type)
+
+
+def _record(rnd: random.Random, mbrs: list, fixed: dict[str, typing.Any]) -> dict[str, typing.Any]:
+    return {m.field_name: fixed[m.field_name] if m.field_name in fixed else _value(rnd, m.field_type)
+            for m in mbrs}
+
+
+def _rates(rnd: random.Random, n_resources: int, count: int) -> tuple[tuple[int, ...], tuple[float, ...]]:
+    ids = tuple(rnd.sample(range(4, n_resources + 1), count))  # 1-based, after the special resources
+    return ids, tuple(rnd.randrange(1, 8) / 4 for _ in ids)
+
+
+def make_resources(rnd: random.Random, mbrs: list, n_resources: int) -> list[dict[str, typing.Any]]:
+    # The analysis refers to these three by alias
+    aliases = ['FRESH AIR', 'WILDERNESS', 'MONEY'] + ['RESOURCE %03d' % i for i in range(3, n_resources)]
+    return [_record(rnd, mbrs, {'alias': alias, 'myName': alias.lower()}) for alias in aliases]
+
+
+def make_resource_db(rnd: random.Random, n_resources: int) -> bytes:
+    mbrs = list(get_members(Path('ResourceItem.cs').read_text(encoding='utf-8')))
+    data = bytearray(248)  # ResourceDatabase members ahead of the item list
+    for item in make_resources(rnd, mbrs, n_resources):
+        data += b''.join(encode(m.field_type, item[m.field_name]) for m in mbrs)
+    return bytes(data)
+
+
+def make_block(rnd: random.Random, mbrs: list, index: int, n_resources: int) -> dict[str, typing.Any]:
+    # Header strings must be long enough for the decoder's printable-run search
+    header = ('%s %s %d' % (rnd.choice(words), rnd.choice(words), index)).upper().ljust(10, '_')
+    inputs, inputs_amounts = _rates(rnd, n_resources, rnd.randrange(4))
+    outputs, outputs_amounts = _rates(rnd, n_resources, rnd.randrange(1, 4))
+    opt, opt_amounts = _rates(rnd, n_resources, rnd.randrange(2))
+    if index % 10 == 1:
+        # Guarantee a feasible zero-footprint solution: fresh air and wilderness for a little money
+        inputs, inputs_amounts, opt, opt_amounts = (3,), (0.25,), (), ()
+        outputs, outputs_amounts = (1, 2), (1., 0.5)
+    else:
+        outputs += (1,)
+        outputs_amounts += (rnd.randrange(4) / 4,)
+
+    fixed = {
+        'toolTipHeader': header,
+        'toolTipContent': '' if index % 7 == 3 else 'this block makes ' + _text(rnd, 4),
+        'myName': header.title(),
+        'category': 10 if index % 9 == 4 else rnd.choice((1, 2, 3, 4, 6, 7, 8, 9, 11)),  # Some WILD_TILES
+        'inputs': inputs, 'inputsAmounts': inputs_amounts,
+        'outputs': outputs, 'outputsAmounts': outputs_amounts,
+        'optionalInputs': opt, 'optionalInputsAmounts': opt_amounts,
+        'myAgents': (),
+        'allAgentFunctionsString': (agent_needle,) + tuple(_text(rnd, 1) for _ in range(rnd.randrange(3))),
+        'callOnce': 1, 'callOnce2': 1, 'cantiliverAmmount': 1000, 'distanceToStreet': 1000,
+    }
+    for m in mbrs:
+        if m.field_name.startswith(('alias_', 'description_')):
+            fixed[m.field_name] = _text(rnd, 1 + rnd.randrange(4))
+    return _record(rnd, mbrs, fixed)
+
+
+def encode_block(mbrs: list, block: dict[str, typing.Any]) -> bytes:
+    names = [m.field_name for m in mbrs]
+    order = []
+    for first, last in block_layout:
+        order.extend(range(names.index(first), names.index(last) + 1))
+    order.extend(i for i in range(len(mbrs)) if i not in order)
+    return b''.join(encode(mbrs[i].field_type, block[names[i]]) for i in order)
+
+
+def make_block_db(rnd: random.Random, n_blocks: int, n_resources: int) -> bytes:
+    mbrs = list(get_members(Path('Block.cs').read_text(encoding='utf-8')))
+    # The first record is a template that the decoder skips
+    records = [encode_block(mbrs, make_block(rnd, mbrs, i, n_resources)) for i in range(n_blocks + 1)]
+    return records[0] + pack('i', n_blocks) + b''.join(records[1:])
+
+
+def _node(type_name: str, name: str, children: typing.Sequence[Node] = (), byte_size: int = -1,
+          flags: int = 0, is_array: bool = False) -> Node:
+    # Levels are assigned when the tree is written
+    return Node(type_name, name, 0, is_array, byte_size, flags, list(children))
+
+
+def _leaf(type_name: str, name: str, flags: int = 0) -> Node:
+    return _node(type_name, name, byte_size=primitives[type_name].size, flags=flags)
+
+
+def _vector(item: Node, name: str, type_name: str = 'vector', flags: int = ALIGN_FLAG) -> Node:
+    array = _node('Array', 'Array', (_leaf('int', 'size'), item), is_array=True)
+    return _node(type_name, name, (array,), flags=flags)
+
+
+def _pptr(type_name: str, name: str) -> Node:
+    return _node('PPtr<%s>' % type_name, name, (_leaf('int', 'm_FileID'), _leaf('SInt64', 'm_PathID')), 12)
+
+
+def field_node(field_type: FieldType, name: str, type_name: str = 'Object') -> Node:
+    if isinstance(field_type, Bool):
+        return _leaf('bool', name, ALIGN_FLAG)
+    if isinstance(field_type, (Int, Enum)):
+        return _leaf('int', name)
+    if isinstance(field_type, Float):
+        return _leaf('float', name)
+    if isinstance(field_type, String):
+        return _vector(_leaf('char', 'data'), name, 'string')
+    if isinstance(field_type, (AssetRef, GameObject)):
+        return _pptr(type_name, name)
+    if isinstance(field_type, Vector3):
+        return _node('Vector3f', name, [_leaf('float', c) for c in 'xyz'], 12)
+    if isinstance(field_type, List):
+        return _vector(field_node(field_type.inner, 'data'), name)
+    raise TypeError(field_type)
+
+
+def class_node(type_name: str, name: str, mbrs: list) -> Node:
+    return _node(type_name, name, [field_node(m.field_type, m.field_name, m.type_name) for m in mbrs])
+
+
+def mono_behaviour_tree(*fields: Node) -> Node:
+    return _node('MonoBehaviour', 'Base', (_pptr('GameObject', 'm_GameObject'),
+                                           _leaf('UInt8', 'm_Enabled', ALIGN_FLAG),
+                                           _pptr('MonoScript', 'm_Script'),
+                                           field_node(String(), 'm_Name')) + fields)
+
+
+def typed_value(field_type: FieldType, val: typing.Any) -> typing.Any:
+    # From the values written by encode() to those write_typed() expects
+    if isinstance(field_type, (AssetRef, GameObject)):
+        return {'m_FileID': val[0], 'm_PathID': val[1]}
+    if isinstance(field_type, Vector3):
+        return dict(zip('xyz', val))
+    if isinstance(field_type, List):
+        return tuple(typed_value(field_type.inner, v) for v in val)
+    return val
+
+
+def typed_record(mbrs: list, record: dict[str, typing.Any]) -> dict[str, typing.Any]:
+    return {m.field_name: typed_value(m.field_type, record[m.field_name]) for m in mbrs}
+
+
+def write_typed(node: Node, val: typing.Any, out: bytearray) -> None:
+    """
+    Serialize `val` as described by `node`, aligning relative to the start of `out`.
+    """
+    if node.type_name == 'string':
+        raw = val.encode('utf-8')
+        out += pack('<i', len(raw)) + raw
+    elif node.type_name == 'TypelessData':
+        out += pack('<i', len(val)) + val
+    elif node.type_name in primitives and not node.children:
+        out += primitives[node.type_name].pack(val)
+    elif node.children and node.children[0].is_array:
+        item = node.children[0].children[1]
+        out += pack('<i', len(val))
+        for v in val:
+            write_typed(item, v, out)
+    else:
+        for child in node.children:
+            write_typed(child, val[child.name], out)
+    if node.type_name == 'string' or node.meta_flag & ALIGN_FLAG:
+        out += bytes(-len(out) & 3)
+
+
+def _common_offsets() -> dict[str, int]:
+    offsets, offset = {}, 0
+    for s in common_strings:
+        offsets[s] = offset | COMMON_FLAG
+        offset += len(s) + 1
+    return offsets
+
+
+common_offsets = _common_offsets()
+
+
+def type_tree_blob(root: Node) -> bytes:
+    nodes, local, local_offsets = [], bytearray(), {}
+
+    def offset(s: str) -> int:
+        if s in common_offsets:
+            return common_offsets[s]
+        if s not in local_offsets:
+            local_offsets[s] = len(local)
+            local.extend(s.encode('utf-8') + b'\0')
+        return local_offsets[s]
+
+    def walk(node: Node, level: int) -> None:
+        nodes.append(node_struct.pack(1, level, node.is_array, offset(node.type_name), offset(node.name),
+                                      node.byte_size, len(nodes), node.meta_flag))
+        for child in node.children:
+            walk(child, level + 1)
+
+    walk(root, 0)
+    return pack('<ii', len(nodes), len(local)) + b''.join(nodes) + local
+
+
+filler_tree = mono_behaviour_tree(_node('TypelessData', 'data', (_leaf('UInt8', 'data'),), flags=ALIGN_FLAG))
+texture_tree = _node('Texture2D', 'Base', (field_node(String(), 'm_Name'),
+                                           _node('TypelessData', 'image data', (_leaf('UInt8', 'data'),))))
+
+
+def typed_object(tree: Node, name: str, fields: dict[str, typing.Any]) -> bytes:
+    out = bytearray()
+    write_typed(tree, {'m_GameObject': {'m_FileID': 0, 'm_PathID': 1}, 'm_Enabled': 1,
+                       'm_Script': {'m_FileID': 0, 'm_PathID': 2}, 'm_Name': name, **fields}, out)
+    return bytes(out)
+
+
+def make_typed_dbs(rnd: random.Random, n_blocks: int, n_resources: int) -> tuple[
+    tuple[Node, bytes],
+    tuple[Node, bytes],
+]:
+    """
+    The same databases as make_block_db and make_resource_db draw from `rnd`, as type trees and the
+    objects they describe.
+    """
+    block_mbrs = list(get_members(Path('Block.cs').read_text(encoding='utf-8')))
+    resource_mbrs = list(get_members(Path('ResourceItem.cs').read_text(encoding='utf-8')))
+    blocks = [typed_record(block_mbrs, make_block(rnd, block_mbrs, i, n_resources))
+              for i in range(n_blocks + 1)]
+    resources = [typed_record(resource_mbrs, r) for r in make_resources(rnd, resource_mbrs, n_resources)]
+
+    block_tree = mono_behaviour_tree(class_node('Block', 'template', block_mbrs),
+                                     _vector(class_node('Block', 'data', block_mbrs), 'blocks'))
+    resource_tree = mono_behaviour_tree(_vector(class_node('ResourceItem', 'data', resource_mbrs), 'items'))
+    return ((block_tree, typed_object(block_tree, 'blockDB_current',
+                                      {'template': blocks[0], 'blocks': tuple(blocks[1:])})),
+            (resource_tree, typed_object(resource_tree, 'resourceDB', {'items': tuple(resources)})))
+
+
+def mono_behaviour(name: str, data: bytes) -> bytes:
+    raw = name.encode('utf-8')
+    head = pack('<IQ?xxx', 0, 1, True) + pack('<IQ', 0, 2)
+    return head + pack('I', len(raw)) + raw + bytes(-len(raw) & 3) + data
+
+
+def serialized_file(
+    objects: typing.Sequence[tuple[int, int, str, bytes]],
+    trees: dict[str, Node] | None = None,
+) -> bytes:
+    """
+    Build a serialized file from (path_id, class_id, script, payload) tuples. With `trees`, each script
+    name is a type of its own, described by its tree; without, all objects of a class share one type.
+    """
+    type_keys = sorted({(c, s if trees else '') for _, c, s, _ in objects})
+    engine = b'2017.4.40f1\0' if trees else b'5.6.2f1\0'
+    meta = bytearray(engine + pack('<I?I', 19, trees is not None, len(type_keys)))
+    for script, (class_id, name) in enumerate(type_keys):
+        is_mono = class_id == MONO_BEHAVIOUR
+        meta += pack('<Ixh', class_id, script if is_mono else -1)
+        blob = type_tree_blob(trees[name]) if trees else b''
+        if is_mono:
+            meta += md5(name.encode('utf-8')).digest() if trees else bytes(16)  # Script ID
+        meta += md5(blob).digest() if trees else bytes(16)                       # Old type hash
+        meta += blob
+
+    offsets, offset = [], 0
+    for _, _, _, payload in objects:
+        offsets.append(offset)
+        offset += len(payload) + (-len(payload) & 7)
+
+    meta += pack('I', len(objects))
+    for (path_id, class_id, name, payload), obj_offset in zip(objects, offsets):
+        meta += bytes(-(20 + len(meta)) & 3)
+        type_index = type_keys.index((class_id, name if trees else ''))
+        meta += pack('QIII', path_id, obj_offset, len(payload), type_index)
+    meta += pack('I', 0)  # Script types
+    meta += pack('I', 0)  # Externals
+
+    data_offset = 20 + len(meta) + (-(20 + len(meta)) & 15)
+    file_size = data_offset + offset
+    out = bytearray(pack('>IIIIxxxx', len(meta), file_size, 17, data_offset))
+    out += meta
+    out += bytes(data_offset - len(out))
+    for _, _, _, payload in objects:
+        out += payload + bytes(-len(payload) & 7)
+    return bytes(out)
+
+
+def lz4_compress(data: bytes) -> bytes:
+    """
+    A greedy LZ4 block compressor: matches are found through the last position of each 4-byte sequence.
+    """
+    def run_length(n: int) -> bytes:
+        return bytes([255] * (n // 255) + [n % 255])
+
+    def sequence(literals: bytes, offset: int = 0, match: int = 0) -> bytes:
+        token = min(len(literals), 15) << 4 | (min(match - 4, 15) if offset else 0)
+        seq = bytearray([token])
+        if len(literals) >= 15:
+            seq += run_length(len(literals) - 15)
+        seq += literals
+        if offset:
+            seq += pack('<H', offset)
+            if match - 4 >= 15:
+                seq += run_length(match - 19)
+        return bytes(seq)
+
+    # The format requires the last match to start 12 bytes before the end, and end 5 bytes before it
+    out, last = [], {}
+    pos = anchor = 0
+    while pos < len(data) - 12:
+        key = data[pos: pos + 4]
+        prev = last.get(key)
+        last[key] = pos
+        if prev is None or pos - prev > 0xffff:
+            pos += 1
+            continue
+        match = 4
+        while pos + match < len(data) - 5 and data[prev + match] == data[pos + match]:
+            match += 1
+        out.append(sequence(data[anchor: pos], pos - prev, match))
+        pos = anchor = pos + match
+    out.append(sequence(data[anchor:]))
+    return b''.join(out)
+
+
+def lzma_compress(data: bytes) -> bytes:
+    lc, lp, pb, dict_size = 3, 0, 2, 1 << 20
+    raw = lzma.compress(data, lzma.FORMAT_RAW, filters=[
+        {'id': lzma.FILTER_LZMA1, 'dict_size': dict_size, 'lc': lc, 'lp': lp, 'pb': pb}])
+    return pack('<BI', (pb*5 + lp)*9 + lc, dict_size) + raw
+
+
+compressors = {bundle.NONE: bytes, bundle.LZMA: lzma_compress, bundle.LZ4: lz4_compress}
+
+
+def unity_bundle(files: typing.Sequence[tuple[str, bytes]], compression: int = bundle.LZ4,
+                 block_size: int = 0x20000) -> bytes:
+    """
+    Build a format-6 UnityFS bundle of (name, serialized file) pairs, compressing `block_size` pieces
+    of their concatenation.
+    """
+    stream = b''.join(data for _, data in files)
+    compress = compressors[compression]
+    blocks = [compress(stream[i: i + block_size]) for i in range(0, len(stream), block_size)]
+
+    info = bytearray(16) + pack('>i', len(blocks))
+    for i, block in enumerate(blocks):
+        info += bundle.block_struct.pack(len(stream[i*block_size: (i + 1)*block_size]), len(block),
+                                         compression)
+    info += pack('>i', len(files))
+    offset = 0
+    for name, data in files:
+        info += bundle.node_struct.pack(offset, len(data), bundle.SERIALIZED_FILE)
+        info += name.encode('utf-8') + b'\0'
+        offset += len(data)
+    packed_info = lz4_compress(bytes(info))
+
+    head = bundle.SIGNATURE + pack('>I', 6) + b'5.x.x\0' + b'5.6.2f1\0'
+    size = len(head) + 20 + len(packed_info) + sum(map(len, blocks))
+    head += pack('>qIII', size, len(packed_info), len(info), bundle.LZ4 | bundle.HAS_DIRECTORY)
+    return head + packed_info + b''.join(blocks)
+
+
+def write_game_dir(
+    steam_prefix: Path,
+    n_blocks: int = 240,
+    n_resources: int = 78,
+    n_files: int = 4,
+    n_filler: int = 2000,
+    seed: int = 0,
+    version: str = default_version,
+    type_trees: bool = False,
+    compression: int | None = None,
+) -> Path:
+    """
+    Write a game data directory under `steam_prefix` where get_dbs will look for it. The databases go
+    in the last file, so that a scan has to get through all of the others first. The same seed gives
+    the same databases with or without type trees. With a `compression` from unity_bundle, the files
+    are packed into a single data.unity3d bundle instead.
+    """
+    rnd = random.Random(seed)
+    directory = data_dir(steam_prefix, version)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    trees = {'Filler': filler_tree, 'Texture2D': texture_tree} if type_trees else None
+    files = []
+    path_id = 1
+    for file_i in range(n_files):
+        objects = []
+        for _ in range(n_filler):
+            if rnd.random() < 0.2:
+                name, data = _text(rnd, 2), bytes(rnd.randrange(16, 512))
+                if type_trees:
+                    payload = typed_object(filler_tree, name, {'data': data})
+                else:
+                    payload = mono_behaviour(name, data)
+                objects.append((path_id, MONO_BEHAVIOUR, 'Filler', payload))
+            else:
+                data = bytes(rnd.randrange(64, 4096))
+                if type_trees:
+                    out = bytearray()
+                    write_typed(texture_tree, {'m_Name': '', 'image data': data}, out)
+                    data = bytes(out)
+                objects.append((path_id, TEXTURE_2D, 'Texture2D', data))
+            path_id += 1
+        if file_i == n_files - 1:
+            if type_trees:
+                (block_tree, block_db), (resource_tree, resource_db) = make_typed_dbs(
+                    rnd, n_blocks, n_resources)
+                trees.update(BlockDatabase=block_tree, ResourceDatabase=resource_tree)
+            else:
+                block_db = mono_behaviour('blockDB_current', make_block_db(rnd, n_blocks, n_resources))
+                resource_db = mono_behaviour('resourceDB', make_resource_db(rnd, n_resources))
+            objects.append((block_id, MONO_BEHAVIOUR, 'BlockDatabase', block_db))
+            objects.append((resource_id, MONO_BEHAVIOUR, 'ResourceDatabase', resource_db))
+        files.append(('sharedassets%d.assets' % file_i, serialized_file(objects, trees)))
+
+    if compression is None:
+        for name, data in files:
+            (directory / name).write_bytes(data)
+    else:
+        (directory / 'data.unity3d').write_bytes(unity_bundle(files, compression))
+    return directory
+
+
+if __name__ == '__main__':
+    import sys
+    print(write_game_dir(Path(sys.argv[1])))
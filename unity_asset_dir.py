@@ -1,19 +1,32 @@
+import re
 import typing
 from io import BytesIO, SEEK_CUR, SEEK_SET
 from pathlib import Path
 from struct import unpack
 
+import metrics
+from unity_bundle import SIGNATURE, Bundle
+from unity_type_tree import Reader, get_reader
+
 # Unity asset directory file
 # See https://github.com/Perfare/AssetStudio
 
 
 MONO_BEHAVIOUR = 114
+default_version = 'v0_40_08'
+asset_patterns = ('*.assets', '*.unity3d', '*.bundle')  # Serialized files and UnityFS bundles
+
+
+class UnsupportedFileError(Exception):
+    pass
 
 
 def str_to_nul(f: typing.BinaryIO) -> str:
     s = BytesIO()
     while True:
         b = f.read(1)
+        if not b:
+            raise EOFError('Unterminated string')
         if not b[0]:
             break
         s.write(b)
@@ -30,8 +43,13 @@ def f_int(f: typing.BinaryIO) -> int:
     return unpack('I', f.read(4))[0]
 
 
-def get_classes(f: typing.BinaryIO, base_count: int) -> list[tuple[int, int]]:
+def get_classes(
+    f: typing.BinaryIO,
+    base_count: int,
+    type_trees: bool,
+) -> tuple[list[tuple[int, int]], list[Reader | None]]:
     class_ids = []
+    readers = []
     for _ in range(base_count):
         class_id, type1 = unpack('<Ixh', f.read(7))
         if type1 >= 0:
@@ -39,19 +57,19 @@ def get_classes(f: typing.BinaryIO, base_count: int) -> list[tuple[int, int]]:
         else:
             type1 = class_id
         class_ids.append((type1, class_id))
-        if class_id == MONO_BEHAVIOUR:
-            f.seek(16, SEEK_CUR)
-        f.seek(16, SEEK_CUR)
+        type_hash = f.read(32 if class_id == MONO_BEHAVIOUR else 16)  # Script ID, then old type hash
+        readers.append(get_reader(class_id, type_hash, f) if type_trees else None)
 
-    return class_ids
+    return class_ids, readers
 
 
 def get_preload_table(
     f: typing.BinaryIO,
     class_ids: list[tuple[int, int]],
+    readers: list[Reader | None],
     paths_to_search: typing.Collection[int],
     data_offset: int,
-) -> dict[int, dict[str, int]]:
+) -> dict[int, dict[str, typing.Any]]:
     asset_count = f_int(f)
     preload_table = {}
     for _ in range(asset_count):
@@ -62,6 +80,8 @@ def get_preload_table(
         # if path_id in paths_to_search:
         preload_table[path_id] = {'offset': offset + data_offset,
                                   'size': size, 'type1': type1, 'type2': type2}
+        if readers[index]:
+            preload_table[path_id]['reader'] = readers[index]
     return preload_table
 
 
@@ -100,7 +120,10 @@ def load_mono_behaviour(
     f: typing.BinaryIO,
     preload_table: dict[int, dict[str, int]],
     shared_assets: list[dict[str, str]],
+    names: typing.Collection[str] | None = None,
 ) -> None:
+    # Only the data of MonoBehaviours in `names` is read, if given
+    loaded = 0
     for path_id, asset in preload_table.items():
         try:
             assert (asset['type2'] == MONO_BEHAVIOUR)  # Only type supported here
@@ -113,63 +136,154 @@ def load_mono_behaviour(
             script = get_shared(f, shared_assets)
             name = f.read(f_int(f)).decode('utf-8')
             align4(f)
-            main_size = asset['size'] - (f.tell() - asset['offset'])
+            asset.update({'name': name, 'game_obj': game_obj, 'script': script})
+            if names is not None and name not in names:
+                continue
 
-            asset.update({'name': name, 'game_obj': game_obj, 'script': script,
-                          'data': f.read(main_size)})
+            main_size = asset['size'] - (f.tell() - asset['offset'])
+            asset['data'] = f.read(main_size)
+            loaded += asset['size']
         except AssertionError:
             continue
+    metrics.count('bytes_scanned', loaded)
+
+
+def read_serialized_file(
+    f: typing.BinaryIO,
+    paths_to_search: typing.Collection[int],
+    names: typing.Collection[str] | None = None,
+    search_all: bool = True,
+) -> dict[int, dict[str, typing.Any]]:
+    table_size, data_end, file_gen, data_offset = unpack('>IIIIxxxx', f.read(20))
+    if file_gen != 17:  # Unity 5.5.0+
+        raise UnsupportedFileError('serialized file format %d' % file_gen)
+
+    ver = str_to_nul(f)
+    platform, base_definitions, base_count = unpack('<I?I', f.read(9))
+
+    # Without type trees, object layouts are only known for this build
+    # (platform 5 is StandaloneWindows, 19 StandaloneWindows64)
+    if not base_definitions and (ver != '5.6.2f1' or platform != 19):
+        raise UnsupportedFileError('no type trees, from Unity %s for platform %d' % (ver, platform))
+
+    class_ids, readers = get_classes(f, base_count, base_definitions)
+    preload_table = get_preload_table(f, class_ids, readers, paths_to_search, data_offset)
+    consume_prio_preload(f)
+    shared_assets = get_shared_assets(f)
+    metrics.count('bytes_scanned', f.tell())
+
+    # Objects at the expected path IDs are tried first, so that the rest need not be read if they are
+    # the ones wanted; in a bundle, each object read can mean a block to decompress
+    expected = {p: preload_table[p] for p in paths_to_search if p in preload_table}
+    load_mono_behaviour(f, expected, shared_assets, names)
+    found = {a['name'] for a in expected.values() if 'data' in a}
+    if search_all and (names is None or not found.issuperset(names)):
+        rest = {p: a for p, a in preload_table.items() if p not in expected}
+        load_mono_behaviour(f, rest, shared_assets, names)
+    return preload_table
 
 
 def search_asset_file(
     fn: Path,
     paths_to_search: typing.Collection[int],
-) -> dict[int, dict[str, typing.Any]]:
+    names: typing.Collection[str] | None = None,
+    search_all: bool = True,
+) -> typing.Iterator[dict[int, dict[str, typing.Any]]]:
+    """
+    Yield the preload table of a serialized file, or of each serialized file in a bundle. Bundle
+    nodes are read in place, so only the storage blocks holding the objects that are read get
+    decompressed. Unless `search_all`, only the objects in `paths_to_search` are loaded. Files that
+    are truncated or in an unsupported format are skipped with a warning.
+    """
+    metrics.count('asset_files_opened')
     with fn.open('rb') as f:
-        table_size, data_end, file_gen, data_offset = unpack('>IIIIxxxx', f.read(20))
-        assert(file_gen == 17)  # Unity 5.5.0+
+        is_bundle = f.read(len(SIGNATURE)) == SIGNATURE
+        f.seek(0)
+        if not is_bundle:
+            try:
+                table = read_serialized_file(f, paths_to_search, names, search_all)
+            except (UnsupportedFileError, EOFError) as e:
+                print('\nWarning: skipping %s: %s' % (fn.name, e))
+                return
+            yield table
+            return
+
+        try:
+            bundle = Bundle(f)
+        except (EOFError, ValueError) as e:  # Truncated, or compressed in a way that is not supported
+            print('\nWarning: skipping %s: %s' % (fn.name, e))
+            return
+        for node in bundle.serialized_files():
+            try:
+                table = read_serialized_file(bundle.open(node), paths_to_search, names, search_all)
+            except (UnsupportedFileError, EOFError) as e:
+                print('\nWarning: skipping %s in %s: %s' % (node.path, fn.name, e))
+                continue
+            yield table
 
-        ver = str_to_nul(f)
-        assert(ver == '5.6.2f1')
 
-        platform, base_definitions, base_count = unpack('<I?I', f.read(9))
+def asset_files(directory: Path) -> list[Path]:
+    return sorted(fn for pattern in asset_patterns for fn in directory.glob(pattern))
 
-        # assert(platform == 5)  # StandaloneWindows
-        assert platform == 19    # StandaloneWindows64
 
-        assert(not base_definitions)  # not supported
+def game_dir(steam_prefix: Path) -> Path:
+    return steam_prefix / r'steamapps\common\Blockhood'
 
-        class_ids = get_classes(f, base_count)
-        preload_table = get_preload_table(f, class_ids, paths_to_search, data_offset)
-        consume_prio_preload(f)
-        shared_assets = get_shared_assets(f)
-        load_mono_behaviour(f, preload_table, shared_assets)
 
-    return preload_table
+def decode_object(asset: dict[str, typing.Any]) -> dict[str, typing.Any]:
+    """
+    Decode the script members of a MonoBehaviour loaded from a file with type trees.
+    """
+    val, end = asset['reader'](asset['data'], 0)
+    return val
+
+
+def data_dir(steam_prefix: Path, version: str = default_version) -> Path:
+    return game_dir(steam_prefix) / ('BLOCKHOOD %s_Data' % version)
+
+
+def version_key(version: str) -> tuple[tuple[int, ...], str]:
+    # v0_9_02 before v0_40_08
+    return tuple(int(n) for n in re.findall(r'\d+', version)), version
+
+
+def installed_versions(steam_prefix: Path) -> list[str]:
+    # Builds kept side by side, e.g. a copy of an old data directory made before an update, oldest first
+    return sorted((d.name[len('BLOCKHOOD '): -len('_Data')]
+                   for d in game_dir(steam_prefix).glob('BLOCKHOOD *_Data')), key=version_key)
 
 
-def get_dbs(steam_prefix: Path) -> tuple[
+@metrics.stage('scan')
+def get_dbs(steam_prefix: Path, version: str = default_version) -> tuple[
     dict[str, typing.Any],
     dict[str, typing.Any],
 ]:
     print('Loading game databases...', end=' ')
 
+    # Databases are looked up by name; their path IDs differ between builds, so these are only tried
+    # first before searching every object:
     # block_id, resource_id = 21228, 21231  # in old version
     block_id, resource_id = 21222, 21225  # in 64-bit version
 
-    directory = steam_prefix / r'steamapps\common\Blockhood\BLOCKHOOD v0_40_08_Data'
+    directory = data_dir(steam_prefix, version)
     block_db = None
     resource_db = None
 
-    for fn in directory.glob('*.assets'):
-        dbs = search_asset_file(fn, (block_id, resource_id))
-        by_name = {
-            v['name']: v
-            for v in dbs.values()
-            if 'name' in v
-        }
-        block_db = by_name.get('blockDB_current', block_db)
-        resource_db = by_name.get('resourceDB', resource_db)
+    names = ('blockDB_current', 'resourceDB')
+    for search_all in (False, True):
+        for fn in asset_files(directory):
+            for dbs in search_asset_file(fn, (block_id, resource_id), names, search_all):
+                by_name = {
+                    v['name']: v
+                    for v in dbs.values()
+                    if 'data' in v
+                }
+                block_db = by_name.get('blockDB_current', block_db)
+                resource_db = by_name.get('resourceDB', resource_db)
+                if block_db and resource_db:
+                    break
+            if block_db and resource_db:
+                break
         if block_db and resource_db:
             break
 
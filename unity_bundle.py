@@ -0,0 +1,242 @@
+import io
+import lzma
+import typing
+from bisect import bisect_right
+from collections import OrderedDict
+from struct import Struct, unpack
+
+import metrics
+
+# UnityFS bundles
+#
+# A bundle is a header, a (usually compressed) table of storage blocks and directory nodes, then the
+# storage blocks themselves. The nodes - serialized files and their resources - are laid end to end in
+# one uncompressed stream that the blocks compress a piece at a time. Nodes are opened as file objects
+# over that stream, and only the blocks that a read overlaps are decompressed, with the most recently
+# used ones kept in a small cache. See BundleFile in https://github.com/Perfare/AssetStudio
+
+SIGNATURE = b'UnityFS\0'
+
+NONE, LZMA, LZ4, LZ4HC = range(4)
+COMPRESSION_MASK = 0x3f
+HAS_DIRECTORY = 0x40
+INFO_AT_END = 0x80
+INFO_PADDED = 0x200  # Blocks start on a 16-byte boundary after the info
+SERIALIZED_FILE = 4  # Node flag
+
+block_struct = Struct('>IIH')
+node_struct = Struct('>qqI')
+
+try:
+    from lz4.block import decompress as _lz4_decompress
+except ImportError:
+    _lz4_decompress = None
+
+
+def _run_length(src: bytes, pos: int, length: int) -> tuple[int, int]:
+    while True:
+        b = src[pos]
+        pos += 1
+        length += b
+        if b != 255:
+            return length, pos
+
+
+def lz4_decompress(src: bytes, size: int) -> bytes:
+    """
+    Decompress one LZ4 block, using the lz4 package if it is installed.
+    """
+    if _lz4_decompress is not None:
+        return _lz4_decompress(src, uncompressed_size=size)
+
+    dst = bytearray()
+    pos, end = 0, len(src)
+    while pos < end:
+        token = src[pos]
+        pos += 1
+        literals = token >> 4
+        if literals == 15:
+            literals, pos = _run_length(src, pos, literals)
+        dst += src[pos: pos + literals]
+        pos += literals
+        if pos >= end:
+            break  # The last sequence has no match
+
+        offset = src[pos] | src[pos + 1] << 8
+        pos += 2
+        match = (token & 15) + 4
+        if match == 19:
+            match, pos = _run_length(src, pos, match)
+        start = len(dst) - offset
+        if offset >= match:
+            dst += dst[start: start + match]
+        else:  # The match overlaps its own output, repeating the last `offset` bytes
+            dst += (dst[start:] * (match // offset + 1))[:match]
+
+    if len(dst) != size:
+        raise ValueError('LZ4 block decompressed to %d bytes, expected %d' % (len(dst), size))
+    return bytes(dst)
+
+
+def lzma_decompress(src: bytes, size: int) -> bytes:
+    # Unity writes the 5-byte LZMA properties, then the raw stream without the usual size field
+    props, dict_size = src[0], unpack('<I', src[1:5])[0]
+    lc, props = props % 9, props // 9
+    lp, pb = props % 5, props // 5
+    decomp = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=[
+        {'id': lzma.FILTER_LZMA1, 'dict_size': dict_size, 'lc': lc, 'lp': lp, 'pb': pb}])
+    return decomp.decompress(src[5:], max_length=size)
+
+
+def decompress(compression: int, src: bytes, size: int) -> bytes:
+    if compression == NONE:
+        return src
+    if compression == LZMA:
+        return lzma_decompress(src, size)
+    if compression in (LZ4, LZ4HC):
+        return lz4_decompress(src, size)
+    raise ValueError('Unsupported bundle compression %d' % compression)
+
+
+def str_to_nul(f: typing.BinaryIO) -> str:
+    s = bytearray()
+    while (b := f.read(1)) != b'\0':
+        if not b:
+            raise EOFError('Unterminated string in bundle header')
+        s += b
+    return s.decode('utf-8')
+
+
+class StorageBlock(typing.NamedTuple):
+    offset: int             # In the uncompressed stream
+    size: int
+    file_offset: int
+    compressed_size: int
+    flags: int
+
+
+class BundleNode(typing.NamedTuple):
+    offset: int             # In the uncompressed stream
+    size: int
+    flags: int
+    path: str
+
+
+class Bundle:
+    def __init__(self, f: typing.BinaryIO, cache_blocks: int = 4) -> None:
+        self.f = f
+        self.cache_blocks = cache_blocks
+        self.cache: OrderedDict[int, bytes] = OrderedDict()
+
+        if f.read(len(SIGNATURE)) != SIGNATURE:
+            raise ValueError('Not a UnityFS bundle')
+        fmt, = unpack('>I', f.read(4))
+        self.player_version, self.engine_version = str_to_nul(f), str_to_nul(f)
+        file_size, info_size, info_uncompressed, flags = unpack('>qIII', f.read(20))
+        if fmt >= 7:
+            f.seek(-f.tell() & 15, io.SEEK_CUR)
+
+        if flags & INFO_AT_END:
+            data_start = f.tell()
+            f.seek(file_size - info_size)
+            info = f.read(info_size)
+        else:
+            info = f.read(info_size)
+            data_start = f.tell()
+        if flags & INFO_PADDED:
+            data_start += -data_start & 15
+        info = io.BytesIO(decompress(flags & COMPRESSION_MASK, info, info_uncompressed))
+
+        info.seek(16)  # Hash of the uncompressed data
+        block_count, = unpack('>i', info.read(4))
+        self.blocks = []
+        offset, file_offset = 0, data_start
+        for _ in range(block_count):
+            size, compressed_size, block_flags = block_struct.unpack(info.read(block_struct.size))
+            self.blocks.append(StorageBlock(offset, size, file_offset, compressed_size, block_flags))
+            offset += size
+            file_offset += compressed_size
+        self.block_offsets = [b.offset for b in self.blocks]
+
+        node_count, = unpack('>i', info.read(4))
+        self.nodes = [BundleNode(*node_struct.unpack(info.read(node_struct.size)), str_to_nul(info))
+                      for _ in range(node_count)]
+
+    def block(self, index: int) -> bytes:
+        data = self.cache.get(index)
+        if data is not None:
+            self.cache.move_to_end(index)
+            metrics.count('bundle_cache_hits')
+            return data
+
+        block = self.blocks[index]
+        self.f.seek(block.file_offset)
+        data = decompress(block.flags & COMPRESSION_MASK, self.f.read(block.compressed_size), block.size)
+        metrics.count('bundle_blocks_inflated')
+        metrics.count('bundle_bytes_inflated', block.size)
+
+        self.cache[index] = data
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return data
+
+    def read(self, offset: int, size: int) -> bytes:
+        """
+        Read from the uncompressed stream, decompressing only the blocks that the range overlaps.
+        """
+        parts = []
+        index = bisect_right(self.block_offsets, offset) - 1
+        while size > 0 and index < len(self.blocks):
+            start = offset - self.blocks[index].offset
+            part = self.block(index)[start: start + size]
+            parts.append(part)
+            offset += len(part)
+            size -= len(part)
+            index += 1
+        return b''.join(parts)
+
+    def serialized_files(self) -> list[BundleNode]:
+        return [n for n in self.nodes if n.flags & SERIALIZED_FILE]
+
+    def open(self, node: BundleNode) -> 'NodeFile':
+        return NodeFile(self, node)
+
+
+class NodeFile(io.RawIOBase):
+    """
+    A seekable, read-only file over one node of a bundle.
+    """
+
+    def __init__(self, bundle: Bundle, node: BundleNode) -> None:
+        super().__init__()
+        self.bundle, self.node, self.pos = bundle, node, 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.node.size
+        self.pos = offset
+        return offset
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = self.node.size - self.pos
+        size = max(0, min(size, self.node.size - self.pos))
+        data = self.bundle.read(self.node.offset + self.pos, size)
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b: bytearray) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
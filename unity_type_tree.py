@@ -0,0 +1,196 @@
+import typing
+from io import SEEK_CUR
+from struct import Struct, unpack
+
+from fieldtypes import intern_str
+
+# Unity type trees
+#
+# Serialized files built with type trees carry, for every type, a flattened tree of its members. Here each
+# tree is compiled once into a reader - a closure per node - that is cached by class and type hash and
+# reused for every object of that type. See TypeTreeHelper in https://github.com/Perfare/AssetStudio
+
+ALIGN_FLAG = 0x4000
+COMMON_FLAG = 0x80000000
+
+# Unity's built-in string table, referred to by offset with COMMON_FLAG set. The offsets follow from the
+# order, each string being NUL-terminated.
+common_strings = (
+    'AABB', 'AnimationClip', 'AnimationCurve', 'AnimationState', 'Array', 'Base', 'BitField', 'bitset',
+    'bool', 'char', 'ColorRGBA', 'Component', 'data', 'deque', 'double', 'dynamic_array',
+    'FastPropertyName', 'first', 'float', 'Font', 'GameObject', 'Generic Mono', 'GradientNEW', 'GUID',
+    'GUIStyle', 'int', 'list', 'long long', 'map', 'Matrix4x4f', 'MdFour', 'MonoBehaviour', 'MonoScript',
+    'm_ByteSize', 'm_Curve', 'm_EditorClassIdentifier', 'm_EditorHideFlags', 'm_Enabled', 'm_ExtensionPtr',
+    'm_GameObject', 'm_Index', 'm_IsArray', 'm_IsStatic', 'm_MetaFlag', 'm_Name', 'm_ObjectHideFlags',
+    'm_PrefabInternal', 'm_PrefabParentObject', 'm_Script', 'm_StaticEditorFlags', 'm_Type', 'm_Version',
+    'Object', 'pair', 'PPtr<Component>', 'PPtr<GameObject>', 'PPtr<Material>', 'PPtr<MonoBehaviour>',
+    'PPtr<MonoScript>', 'PPtr<Object>', 'PPtr<Prefab>', 'PPtr<Sprite>', 'PPtr<TextAsset>', 'PPtr<Texture>',
+    'PPtr<Texture2D>', 'PPtr<Transform>', 'Prefab', 'Quaternionf', 'Rectf', 'RectInt', 'RectOffset',
+    'second', 'set', 'short', 'size', 'SInt16', 'SInt32', 'SInt64', 'SInt8', 'staticvector', 'string',
+    'TextAsset', 'TextMesh', 'Texture', 'Texture2D', 'Transform', 'TypelessData', 'UInt16', 'UInt32',
+    'UInt64', 'UInt8', 'unsigned int', 'unsigned long long', 'unsigned short', 'vector', 'Vector2f',
+    'Vector3f', 'Vector4f', 'm_ScriptingClassIdentifier', 'Gradient', 'Type*',
+)
+
+
+def _common_offsets() -> dict[int, str]:
+    offsets, offset = {}, 0
+    for s in common_strings:
+        offsets[offset] = s
+        offset += len(s) + 1
+    return offsets
+
+
+common_by_offset = _common_offsets()
+
+primitives = {name: Struct('<' + fmt) for fmt, names in (
+    ('b', ('SInt8',)),
+    ('B', ('UInt8', 'char')),
+    ('?', ('bool',)),
+    ('h', ('SInt16', 'short')),
+    ('H', ('UInt16', 'unsigned short')),
+    ('i', ('SInt32', 'int')),
+    ('I', ('UInt32', 'unsigned int', 'Type*')),
+    ('q', ('SInt64', 'long long')),
+    ('Q', ('UInt64', 'unsigned long long', 'FileSize')),
+    ('f', ('float',)),
+    ('d', ('double',)),
+) for name in names}
+
+node_struct = Struct('<HBBIIiii')
+int_struct = primitives['int']
+
+Reader = typing.Callable[[bytes, int], tuple[typing.Any, int]]
+
+
+class Node(typing.NamedTuple):
+    type_name: str
+    name: str
+    level: int
+    is_array: bool
+    byte_size: int
+    meta_flag: int
+    children: list['Node']
+
+
+def read_type_tree(f: typing.BinaryIO, node_count: int, str_size: int) -> Node:
+    """
+    Read the nodes and strings of a format-17 type tree blob and return its root node.
+    """
+    raw_nodes = [node_struct.unpack(f.read(node_struct.size)) for _ in range(node_count)]
+    local = f.read(str_size)
+
+    def get_str(offset: int) -> str:
+        if offset & COMMON_FLAG:
+            return common_by_offset.get(offset & ~COMMON_FLAG, '?%d' % (offset & ~COMMON_FLAG))
+        return local[offset: local.index(b'\0', offset)].decode('utf-8')
+
+    stack: list[Node] = []
+    root = None
+    for version, level, is_array, type_off, name_off, byte_size, index, meta_flag in raw_nodes:
+        node = Node(get_str(type_off), get_str(name_off), level, bool(is_array), byte_size, meta_flag, [])
+        del stack[level:]
+        if stack:
+            stack[-1].children.append(node)
+        else:
+            root = node
+        stack.append(node)
+    return root
+
+
+def _aligned(read: Reader) -> Reader:
+    def read_aligned(buf: bytes, pos: int) -> tuple[typing.Any, int]:
+        val, pos = read(buf, pos)
+        return val, (pos + 3) & ~3
+    return read_aligned
+
+
+def compile_node(node: Node) -> Reader:
+    if node.type_name == 'string':
+        def read(buf: bytes, pos: int) -> tuple[str, int]:
+            size, = int_struct.unpack_from(buf, pos)
+            pos += 4
+            return intern_str(buf[pos: pos + size]), (pos + size + 3) & ~3  # Strings always align
+        return read
+
+    if node.type_name == 'TypelessData':
+        def read(buf: bytes, pos: int) -> tuple[bytes, int]:
+            size, = int_struct.unpack_from(buf, pos)
+            pos += 4
+            return buf[pos: pos + size], pos + size
+        return _aligned(read) if node.meta_flag & ALIGN_FLAG else read
+
+    prim = primitives.get(node.type_name)
+    if prim is not None and not node.children:
+        unpack_from, size = prim.unpack_from, prim.size
+
+        def read(buf: bytes, pos: int) -> tuple[typing.Any, int]:
+            return unpack_from(buf, pos)[0], pos + size
+        return _aligned(read) if node.meta_flag & ALIGN_FLAG else read
+
+    if node.children and node.children[0].is_array:
+        # vector, map, staticvector and friends: an Array of (size, data)
+        array = node.children[0]
+        read_item = compile_node(array.children[1])
+        is_map = node.type_name == 'map'
+
+        def read(buf: bytes, pos: int) -> tuple[typing.Any, int]:
+            size, = int_struct.unpack_from(buf, pos)
+            pos += 4
+            items = []
+            for _ in range(size):
+                item, pos = read_item(buf, pos)
+                items.append(item)
+            if is_map:
+                return {item['first']: item['second'] for item in items}, pos
+            return tuple(items), pos
+        if (array.meta_flag | node.meta_flag) & ALIGN_FLAG:
+            return _aligned(read)
+        return read
+
+    fields = [(child.name, compile_node(child)) for child in node.children]
+
+    def read(buf: bytes, pos: int) -> tuple[dict[str, typing.Any], int]:
+        obj = {}
+        for name, read_field in fields:
+            obj[name], pos = read_field(buf, pos)
+        return obj, pos
+    return _aligned(read) if node.meta_flag & ALIGN_FLAG else read
+
+
+def compile_script_reader(root: Node) -> Reader:
+    """
+    A reader for the script members of a MonoBehaviour, i.e. everything after m_Name. unity_asset_dir has
+    already read the common header by the time it keeps an object's data.
+    """
+    names = [child.name for child in root.children]
+    tail = root._replace(children=root.children[names.index('m_Name') + 1:], meta_flag=0)
+    return compile_node(tail)
+
+
+# Compiled readers by class ID and old type hash (and script ID, for MonoBehaviours), shared across files
+readers: dict[tuple[int, bytes], Reader] = {}
+
+
+def get_reader(class_id: int, type_hash: bytes, f: typing.BinaryIO) -> Reader:
+    """
+    Consume the type tree at the current position of `f`. It is only parsed and compiled if no reader
+    for the same class and type hash has been compiled yet. Some builds zero the old type hash, so those
+    trees are compiled every time.
+    """
+    node_count, str_size = unpack('<ii', f.read(8))
+    key = class_id, type_hash
+    cacheable = any(type_hash[-16:])
+    reader = readers.get(key) if cacheable else None
+    if reader is not None:
+        f.seek(node_count*node_struct.size + str_size, SEEK_CUR)
+        return reader
+
+    root = read_type_tree(f, node_count, str_size)
+    if root.type_name == 'MonoBehaviour':
+        reader = compile_script_reader(root)
+    else:
+        reader = compile_node(root)
+    if cacheable:
+        readers[key] = reader
+    return reader
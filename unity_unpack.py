@@ -1,9 +1,11 @@
 from collections import namedtuple
 from fieldtypes import *
-from io import SEEK_SET, BytesIO
-from struct import unpack_from
+from io import SEEK_CUR, SEEK_SET, BytesIO
+from struct import unpack, unpack_from
 import re
 
+import metrics
+
 Member = namedtuple('MemberType', ('field_index', 'access', 'type_name', 'field_name', 'field_type'))
 verbose_decode = False
 
@@ -37,6 +39,7 @@ class JumbledAssetDecoder(AssetDecoder):
     def __init__(self, f, source_fn, first_offset):
         super().__init__(f, source_fn, first_offset)
         self.prev_end = 0
+        self.mbr_index = {m.field_name: i for i, m in enumerate(self.mbrs)}
 
     def _dump_missed(self, used_ranges):
         print('Missed:')
@@ -66,7 +69,12 @@ class JumbledAssetDecoder(AssetDecoder):
                     *(self.mbrs[i].field_name for i in (prev_i, used_i-1))))
             prev_i = used_j
 
-    def decode_one(self, sections):
+    def decode_one(self, sections, fields=None):
+        """
+        Decode the members in each (offset, first member, last member) section. With `fields`, only
+        those members are decoded and the others skipped, and a section is only visited if it has any
+        of them - or if a later section's offset is relative to its end.
+        """
         if verbose_decode:
             print()
             print()
@@ -74,8 +82,17 @@ class JumbledAssetDecoder(AssetDecoder):
             print(self.header)
             used_ranges = []
 
+        bounds = [(self.mbr_index[first], self.mbr_index[last] + 1) for _, first, last in sections]
+        needed = [True] * len(sections)
+        if fields is not None:
+            for s in range(len(sections) - 1, -1, -1):
+                needed[s] = (any(m.field_name in fields for m in self.mbrs[slice(*bounds[s])])
+                             or (s + 1 < len(sections) and needed[s + 1] and sections[s + 1][0] < 1))
+
         item = {}
-        for off, mbr_first, mbr_last in sections:
+        for (off, mbr_first, mbr_last), (mbr_i, mbr_j), need in zip(sections, bounds, needed):
+            if not need:
+                continue
             if off < 1:  # relative
                 curr = self.f.tell()
                 if off != 0:
@@ -83,12 +100,11 @@ class JumbledAssetDecoder(AssetDecoder):
             else:
                 self.f.seek(off, SEEK_SET)
                 curr = off
-            mbr_i = next(i for i,m in enumerate(self.mbrs) if m.field_name == mbr_first)
-            mbr_j = mbr_i + 1 + next(j for j,m in enumerate(self.mbrs[mbr_i:]) if m.field_name == mbr_last)
             for mbr in self.mbrs[mbr_i:mbr_j]:
-                before_fail_pos = self.f.tell()
-                val = mbr.field_type.read(self.f)
-                item[mbr.field_name] = val
+                if fields is None or mbr.field_name in fields:
+                    item[mbr.field_name] = mbr.field_type.read(self.f)
+                else:
+                    mbr.field_type.skip(self.f)
             end = self.f.tell()
 
             if verbose_decode:
@@ -174,6 +190,7 @@ def find_by_int(data, end):
     start_i = i+4
 
     if not(0 <= end-start_i - clen < 4):
+        metrics.count('string_end_realignments')
         newend = start_i + align4(clen)
         end = newend
 
@@ -181,11 +198,13 @@ def find_by_int(data, end):
     return start_i - 4, end, content
 
 
-def get_block_sections(bad, data, agent_list_start):
+def get_block_sections(bad, data, agent_list_start, fields=None):
     # Find a run of printable characters before the agent list
     descstart, descend, descstr = find_str(data, agent_list_start)
 
     if descstr.isupper():
+        # No description, so the run we found is the name
+        metrics.count('empty_description_fallbacks')
         namestart, nameend, namestr = descstart, descend, descstr
         descstart, descend, descstr = nameend, nameend + 4, ''
         assert (unpack('I', data[descstart: descstart + 4]) == (0,))
@@ -196,7 +215,20 @@ def get_block_sections(bad, data, agent_list_start):
     my_name_start, my_name_end, my_name_str = find_by_int(data, is_walkable_start)
     block_to_copy_start = my_name_start - 24
 
-    block_mbr_i = next(i for i,m in enumerate(bad.mbrs) if m.field_name == 'blockToCopy')
+    # This list is not exhaustive
+    sections = [(block_to_copy_start + 4, 'category', 'toolTipContent'),
+                (descend + 8, 'distanceToStreet', 'distanceToStreet'),
+                (descend + 16, 'inputs', 'optionalInputsAmounts'),
+                (agent_list_start, 'allAgentFunctionsString', 'needsAccessToProduce'),
+                (0, 'blockToSwap', 'prevSynergy')]
+
+    # Locating the start of the textures and i18n strings means a search back through every string, so
+    # skip it if none of them is wanted
+    block_mbr_i = bad.mbr_index['blockToCopy']
+    if fields is not None and not any(m.field_name in fields
+                                      for m in bad.mbrs[bad.mbr_index['altTexture2']: block_mbr_i + 1]):
+        return sections
+
     str_end = block_to_copy_start
     for mbr_i in range(block_mbr_i-1, -1, -1):
         mbr = bad.mbrs[mbr_i]
@@ -208,16 +240,21 @@ def get_block_sections(bad, data, agent_list_start):
     # It's doubtful that altTexture1 actually starts here - it looks like boolean data - but...
     # whatever, it parses, and gets us the i18n data correctly after
     tex_start = new_start - 68
+    return [(tex_start, 'altTexture2', 'blockToCopy')] + sections
 
-    # This list is not exhaustive
-    return [(tex_start, 'altTexture2', 'toolTipContent'),
-            (descend + 8, 'distanceToStreet', 'distanceToStreet'),
-            (descend + 16, 'inputs', 'optionalInputsAmounts'),
-            (agent_list_start, 'allAgentFunctionsString', 'needsAccessToProduce'),
-            (0, 'blockToSwap', 'prevSynergy')]
+
+def project(fields):
+    # The block members that unpacking itself relies on, whatever else is asked for
+    if fields is None:
+        return None
+    wanted = set(fields) | {'toolTipHeader', 'myName'}
+    wanted |= {k + 'Amounts' for k in ('inputs', 'outputs', 'optionalInputs') if k in wanted}
+    return wanted
 
 
-def unpack_dbs(block_data, resource_data):
+@metrics.stage('unpack')
+@clears_strings
+def unpack_dbs(block_data, resource_data, fields=None):
     print('Unpacking resource database...', end=' ')
     with BytesIO(resource_data) as f:
         rad = AssetDecoder(f, 'ResourceItem.cs', 248)
@@ -229,6 +266,7 @@ def unpack_dbs(block_data, resource_data):
     agent_needle = 'oneAdjacentNeighbor'.encode('utf-8')
     first = True
 
+    fields = project(fields)
     blocks = []
     with BytesIO(block_data) as f:
         bad = JumbledAssetDecoder(f, 'Block.cs', 0)
@@ -237,15 +275,17 @@ def unpack_dbs(block_data, resource_data):
             if agent_str_start == -1:
                 break
 
+            metrics.count('anchors_found')
             agent_list_start = agent_str_start - 8
             lens = unpack_from('II', block_data, agent_list_start)
             if lens[1] != len(agent_needle) or lens[0] < 1 or lens[0] > 20:
+                metrics.count('anchors_rejected')
                 print('Warning: weird lengths', lens)
             elif first:
                 first = False
             else:
-                block_sects = get_block_sections(bad, block_data, agent_list_start)
-                block = bad.decode_one(block_sects)
+                block_sects = get_block_sections(bad, block_data, agent_list_start, fields)
+                block = bad.decode_one(block_sects, fields)
 
                 # This is a straight-up error in the data
                 if not (block['toolTipHeader'] == 'WETLAND' and block['myName'] == 'T Old Cactus'):
@@ -253,14 +293,80 @@ def unpack_dbs(block_data, resource_data):
 
             agent_str_start += len(agent_needle)
 
+    print('%d blocks, %d/%d fields.' % (len(blocks), len(blocks[0].keys()), len(bad.mbrs)))
+    print()
+
+    return finish_dbs(blocks, rad.items)
+
+
+def finish_dbs(blocks, resources):
     for b in blocks:
         for kn in ('inputs', 'outputs', 'optionalInputs'):
+            if kn not in b:
+                continue
             ka = kn + 'Amounts'
-            b[kn] = {rad.items[n-1]['alias']: round(a, 8)  # Deal with single-to-double error
+            b[kn] = {resources[n-1]['alias']: round(a, 8)  # Deal with single-to-double error
                      for n, a in zip(b[kn], b[ka])}
 
-    print('%d blocks, %d/%d fields.' % (len(blocks), len(blocks[0].keys()), len(bad.mbrs)))
+    return (sorted(blocks, key=lambda b: b['toolTipHeader']),
+            sorted(resources, key=lambda r: r['alias']))
+
+
+def find_records(fields, key):
+    # The database's own member names are not known, so take the first list of records that have `key`
+    for val in fields.values():
+        if isinstance(val, tuple) and val and isinstance(val[0], dict) and key in val[0]:
+            return [dict(v) for v in val]
+    raise KeyError('No list of records with %s' % key)
+
+
+def _legacy(ft, val):
+    # Type trees know enums as ints, PPtrs as {m_FileID, m_PathID} and vectors as {x, y, z}; give them
+    # the shapes that the jumbled decoder reads
+    if isinstance(ft, Enum):
+        return ft.vals[val]
+    if isinstance(ft, (AssetRef, GameObject)):
+        path_id = val['m_PathID'] & 0xffffffffffffffff
+        words = (val['m_FileID'] & 0xffffffff, path_id & 0xffffffff, path_id >> 32)
+        return words + (0,)*(ft.size//4 - len(words))  # The jumbled GameObject reads two more words
+    if isinstance(ft, Vector3):
+        return val['x'], val['y'], val['z']
+    if isinstance(ft, List):
+        return tuple(_legacy(ft.inner, v) for v in val)
+    return val
+
+
+def legacy_shapes(records, source_fn):
+    with open(source_fn, encoding='utf-8') as f:
+        mbrs = list(get_members(f.read()))
+    for m in mbrs:
+        if not records or m.field_name not in records[0]:
+            continue
+        for r in records:
+            r[m.field_name] = _legacy(m.field_type, r[m.field_name])
+
+
+@metrics.stage('unpack')
+def unpack_typed_dbs(block_fields, resource_fields, fields=None):
+    resources = find_records(resource_fields, 'alias')
+    legacy_shapes(resources, 'ResourceItem.cs')
+    print('Unpacked %d resources from type tree.' % len(resources), end=' ')
+
+    blocks = [b for b in find_records(block_fields, 'toolTipHeader')
+              if not (b['toolTipHeader'] == 'WETLAND' and b['myName'] == 'T Old Cactus')]
+    fields = project(fields)
+    if fields is not None:
+        blocks = [{k: v for k, v in b.items() if k in fields} for b in blocks]
+    legacy_shapes(blocks, 'Block.cs')
+    print('%d blocks, %d fields.' % (len(blocks), len(blocks[0].keys())))
     print()
 
-    return (sorted(blocks, key=lambda b: b['toolTipHeader']),
-            sorted(rad.items, key=lambda r: r['alias']))
+    return finish_dbs(blocks, resources)
+
+
+@clears_strings
+def unpack_assets(block_db, resource_db, fields=None):
+    if 'reader' in block_db:
+        from unity_asset_dir import decode_object
+        return unpack_typed_dbs(decode_object(block_db), decode_object(resource_db), fields)
+    return unpack_dbs(block_db['data'], resource_db['data'], fields)
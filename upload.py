@@ -1,19 +1,35 @@
 #!/usr/bin/env python3
 
 import re
+from page_cache import PageCache
+from pathlib import Path
 from requests import session
+from snapshot import load_game_data
 from string import Template
-from unity_asset_dir import get_dbs
-from unity_unpack import unpack_dbs
 
 
 mwurl = 'https://blockhood.gamepedia.com/api.php'
 
 
+# Wiki titles of blocks since renamed in the game, to their game titles, both normalised. Old Man Cactus
+# has no entry: the game's only cactus record is the mislabelled one that unpacking drops.
+aliases = {}
+
+
 class PagedOutError(Exception):
     pass
 
 
+def normalise(title):
+    # The game's headers are upper case and the wiki's are not always title case
+    return ' '.join(title.split()).title()
+
+
+def title_key(title):
+    key = normalise(title)
+    return aliases.get(key, key)
+
+
 class Block:
     re_prop = re.compile(r'\| (\w+) *= *(.*)$', re.M)
     re_cat = re.compile(r'\[\[Category:(?!Blocks)([^\]]+)\]\]')
@@ -29,9 +45,20 @@ class Block:
             'ADV_ORGANIC':     'Organics',
             'WILD_TILES':      'Natural blocks'}
 
-    def __init__(self, title, category, props, id=None, stub=False, discontinued=False, web=False, unity=False):
+    # Fields that each source supplies, besides props
+    web_fields = ('title', 'category', 'id', 'stub', 'discontinued')
+    unity_fields = ('title', 'category')
+
+    def __init__(self, title, category, props, id=None, stub=False, discontinued=False, web=False, unity=False,
+                 sources=None):
         self.title, self.category, self.props, self.id, self.stub, self.discontinued, self.web, self.unity = \
             title, category, props, id, stub, discontinued, web, unity
+        # Field name, or 'props.' and a prop name, to the source it came from: 'web' or 'unity'
+        self.sources = sources or {}
+
+    @staticmethod
+    def _sources(source, fields, props):
+        return dict.fromkeys(fields + tuple('props.' + k for k in props), source)
 
     @staticmethod
     def from_web(data):
@@ -46,7 +73,8 @@ class Block:
             props = {m[1]: m[2] for m in Block.re_prop.finditer(content)}
         return Block(title=data['title'], id=data['pageid'], props=props, stub=stub, web=True,
                      category=Block.re_cat.search(content)[1],
-                     discontinued='Discontinued' in content)
+                     discontinued='Discontinued' in content,
+                     sources=Block._sources('web', Block.web_fields, props))
 
     @staticmethod
     def _add_p(props, name_k, qty_k, name, val, index):
@@ -69,8 +97,25 @@ class Block:
         for out_i, (out_n, out_x) in enumerate(data['outputs'].items(), start=1):
             Block._add_p(props, 'output', 'out', out_n, out_x, out_i)
 
-        return Block(title=data['toolTipHeader'].title(),
-                     category=Block.cats[data['category']], props=props, unity=True)
+        return Block(title=normalise(data['toolTipHeader']),
+                     category=Block.cats[data['category']], props=props, unity=True,
+                     sources=Block._sources('unity', Block.unity_fields, props))
+
+    @staticmethod
+    def reconcile(bu, bw):
+        """
+        One block from its game and wiki versions. The game decides the title, category and the
+        properties it fills in; the wiki the page ID and flags, and the properties the game leaves blank.
+        """
+        props = {**bu.props, **bw.props}
+        sources = {**bu.sources, **bw.sources}
+        sources.update(dict.fromkeys(Block.unity_fields, 'unity'))
+        for k, v in bu.props.items():
+            if v != '':
+                props[k] = v
+                sources['props.' + k] = 'unity'
+        return Block(title=bu.title, category=bu.category, props=props, id=bw.id, stub=bw.stub,
+                     discontinued=bw.discontinued, web=True, unity=True, sources=sources)
 
     def __str__(self):
         return self.category + '.' + self.title
@@ -84,18 +129,20 @@ class Block:
         return tpl.substitute(self.props, cat=self.category)
 
 
-def download(sess):
-    print('Loading blocks from Gamepedia...')
+def _list_pages(sess, cache):
+    # Lightweight listing: page IDs and latest revision IDs only, no content
     params = {'action': 'query',
               'generator': 'categorymembers',
               'gcmtitle': 'Category:Blocks',
               'gcmtype': 'page',
               'gcmlimit': 250,
-              'prop': 'revisions',
-              'rvprop': 'content',
+              'prop': 'info',
               'meta': 'tokens'}
-    blocks = []
-    n_complete, n_discontinued, n_stub = 0, 0, 0
+    if cache.checkpoint is None:
+        cache.listing = {}
+    else:
+        print('Resuming interrupted listing at %d pages' % len(cache.listing))
+        params.update(cache.checkpoint)
     edit_token = None
 
     while True:
@@ -106,58 +153,116 @@ def download(sess):
         if new_token:
             edit_token = new_token
 
-        for block_data in body['query']['pages'].values():
-            try:
-                block = Block.from_web(block_data)
-                if block.stub:
-                    n_stub += 1
-                elif block.discontinued:
-                    n_discontinued += 1
-                else:
-                    n_complete += 1
-                blocks.append(block)
-            except PagedOutError:
-                pass
-
-        print('Processed %d complete, %d discontinued, %d stubs' % (n_complete, n_discontinued, n_stub))
+        for page in body['query']['pages'].values():
+            cache.listing[str(page['pageid'])] = page['lastrevid']
 
         if 'batchcomplete' in body:
+            cache.checkpoint = None
+            cache.save()
             break
+        cache.checkpoint = body['continue']
+        cache.save()
         params.update(body['continue'])
+
+    return edit_token
+
+
+def _fetch_pages(sess, cache, page_ids):
+    for i in range(0, len(page_ids), 50):  # API limit on pageids per query
+        params = {'action': 'query',
+                  'pageids': '|'.join(page_ids[i: i+50]),
+                  'prop': 'revisions',
+                  'rvprop': 'content|ids'}
+        while True:
+            resp = sess.get(mwurl, params=params)
+            resp.raise_for_status()
+            body = resp.json()
+
+            for page in body['query']['pages'].values():
+                if page.get('revisions'):  # Otherwise paged out to a continuation
+                    cache.put(page)
+
+            if 'batchcomplete' in body:
+                break
+            params.update(body['continue'])
+
+        cache.save()
+        print('Fetched %d/%d changed pages' % (min(i+50, len(page_ids)), len(page_ids)))
+
+
+def download(sess, cache=None):
+    print('Loading blocks from Gamepedia...')
+    if cache is None:
+        cache = PageCache()
+
+    edit_token = _list_pages(sess, cache)
+    stale = cache.stale()
+    print('%d pages listed, %d changed since last sync' % (len(cache.listing), len(stale)))
+    _fetch_pages(sess, cache, stale)
+    if cache.prune():
+        cache.save()
+
+    blocks = []
+    n_complete, n_discontinued, n_stub = 0, 0, 0
+    for block_data in cache.current():
+        try:
+            block = Block.from_web(block_data)
+            if block.stub:
+                n_stub += 1
+            elif block.discontinued:
+                n_discontinued += 1
+            else:
+                n_complete += 1
+            blocks.append(block)
+        except PagedOutError:
+            pass
+
+    print('Processed %d complete, %d discontinued, %d stubs' % (n_complete, n_discontinued, n_stub))
     print()
 
     return sorted(blocks), edit_token
 
 
-def load_un():
-    block_db, resource_db = get_dbs(r'D:\Program Files\SteamLibrary')
-    blocks_un, resources_un = unpack_dbs(block_db['data'], resource_db['data'])
+def load_un(steam_prefix, snapshot_root=Path('snapshot'), version=None):
+    blocks_un, resources_un = load_game_data(steam_prefix, snapshot_root, version)
     return [Block.from_unity(b) for b in blocks_un]
 
 
 def merge(blocks_web, blocks_un):
-    web_lookup = {w.title.title(): w for w in blocks_web}
-    un_lookup = {u.title.title(): u for u in blocks_un}
-    web_names = set(web_lookup.keys())
-    un_names = set(un_lookup.keys())
-    both = web_names & un_names
-    only_web = web_names - un_names
-    only_un = un_names - web_names
+    """
+    Reconcile the wiki and game blocks into one list, matched on normalised title or alias in a single
+    pass over each: game blocks in their order, then those only on the wiki. Of blocks with the same
+    title in one source, the first is kept.
+    """
+    index = {}
+    for bw in blocks_web:
+        key = title_key(bw.title)
+        if key in index:
+            print('Warning: wiki pages %s and %s are the same block' % (index[key].title, bw.title))
+        else:
+            index[key] = bw
 
     merged = []
-
-    for bn in only_un:
-        merged.append(un_lookup[bn])
-    for bn in only_web:
-        merged.append(web_lookup[bn])
-    for bn in both:
-        bu = un_lookup[bn]
-        bw = web_lookup[bn]
-        bu.id, bu.web, bu.stub, bu.discontinued = bw.id, bw.web, bw.stub, bw.discontinued
-
-    print('Blocks only on the web, probably deprecated:', ', '.join(only_web))
-    print('Blocks missing from the web:', len(only_un))
-    print('Blocks present in both:', len(both))
+    game_keys = set()
+    n_both = 0
+    for bu in blocks_un:
+        key = title_key(bu.title)
+        if key in game_keys:
+            print('Warning: skipping second game block titled %s' % bu.title)
+            continue
+        game_keys.add(key)
+        bw = index.pop(key, None)
+        if bw is None:
+            merged.append(bu)
+        else:
+            merged.append(Block.reconcile(bu, bw))
+            n_both += 1
+    only_web = list(index.values())  # Whatever no game block claimed
+    merged.extend(only_web)
+
+    print('Blocks only on the web, probably deprecated:', ', '.join(b.title for b in only_web))
+    print('Blocks missing from the web:', len(game_keys) - n_both)
+    print('Blocks present in both:', n_both)
     print()
 
     return merged
@@ -205,10 +310,10 @@ def upload(sess, blocks, edit_token, update=True):
         assert(body['edit']['result'] == 'Success')
 
 
-def main():
+def main(steam_prefix, snapshot_root=Path('snapshot'), version=None):
     sess = login()
     blocks_web, edit_token = download(sess)
-    blocks_un = load_un()
+    blocks_un = load_un(steam_prefix, snapshot_root, version)
     blocks = merge(blocks_web, blocks_un)
 
     # Update stubs only
@@ -222,4 +327,9 @@ def main():
     return
 
 
-main()
+if __name__ == '__main__':
+    # The game path and other options come from main.py's command line and config
+    import sys
+    from main import main as run
+    sys.argv.append('upload')
+    run()
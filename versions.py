@@ -0,0 +1,139 @@
+import hashlib
+import typing
+
+# Block database differences across game versions
+#
+# Every block is fingerprinted by hashing each of its decoded fields, then hashing those field digests
+# together. Blocks with the same fingerprint in several versions are stored once, and comparing two
+# versions only needs the per-field digests of the blocks whose fingerprints differ.
+#
+# Asset pointers are path IDs, which change from build to build whether or not the asset did, so by
+# default they are left out of the fingerprints. Their values are still kept for each version.
+
+Record = dict[str, typing.Any]
+
+
+def pointer_fields(source_fn: str = 'Block.cs') -> set[str]:
+    """
+    Members of the class in `source_fn` that hold asset pointers, directly or in lists.
+    """
+    from fieldtypes import AssetRef, GameObject, List
+    from unity_unpack import get_members
+
+    with open(source_fn, encoding='utf-8') as f:
+        mbrs = list(get_members(f.read()))
+    fields = set()
+    for m in mbrs:
+        ft = m.field_type
+        while isinstance(ft, List):
+            ft = ft.inner
+        if isinstance(ft, (AssetRef, GameObject)):
+            fields.add(m.field_name)
+    return fields
+
+
+def _canonical(val: typing.Any) -> str:
+    # repr() is stable for everything the decoders produce, except that dict order must not matter
+    if isinstance(val, dict):
+        return '{%s}' % ', '.join('%r: %s' % (k, _canonical(v)) for k, v in sorted(val.items()))
+    if isinstance(val, tuple):
+        return '(%s)' % ', '.join(_canonical(v) for v in val)
+    return repr(val)
+
+
+def field_digests(block: Record, ignore: typing.Collection[str] = ()) -> dict[str, bytes]:
+    return {k: hashlib.blake2b(_canonical(v).encode('utf-8'), digest_size=8).digest()
+            for k, v in block.items() if k not in ignore}
+
+
+def fingerprint(digests: dict[str, bytes]) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    for k in sorted(digests):
+        h.update(k.encode('utf-8'))
+        h.update(digests[k])
+    return h.digest()
+
+
+class Change(typing.NamedTuple):
+    key: str
+    fields: tuple[str, ...]
+
+
+class VersionDiff(typing.NamedTuple):
+    old: str
+    new: str
+    added: list[str]
+    removed: list[str]
+    changed: list[Change]
+
+
+class BlockStore:
+    def __init__(self, key: typing.Callable[[Record], str] = lambda b: b['toolTipHeader'],
+                 ignore: typing.Collection[str] = ()) -> None:
+        self.key = key
+        self.ignore = frozenset(ignore)                  # Fields left out of the fingerprints
+        self.blocks: dict[bytes, Record] = {}            # Fingerprint to the one shared copy of a block
+        self.digests: dict[bytes, dict[str, bytes]] = {}
+        self.versions: dict[str, dict[str, bytes]] = {}  # Version to block key to fingerprint
+        self.ignored: dict[str, dict[str, Record]] = {}  # Version to block key to its ignored fields
+
+    def add_version(self, version: str, blocks: typing.Iterable[Record]) -> None:
+        index, ignored = {}, {}
+        for block in blocks:
+            digests = field_digests(block, self.ignore)
+            fp = fingerprint(digests)
+            if fp not in self.blocks:
+                self.blocks[fp] = {k: v for k, v in block.items() if k not in self.ignore}
+                self.digests[fp] = digests
+            key = self.key(block)
+            n = 2
+            while key in index:  # Disambiguate duplicate names by order of appearance
+                key = '%s #%d' % (self.key(block), n)
+                n += 1
+            index[key] = fp
+            if self.ignore:
+                ignored[key] = {k: v for k, v in block.items() if k in self.ignore}
+        self.versions[version] = index
+        self.ignored[version] = ignored
+
+    def get(self, version: str, key: str) -> Record:
+        block = self.blocks[self.versions[version][key]]
+        extra = self.ignored[version].get(key)
+        return {**block, **extra} if extra else block
+
+    def diff(self, old: str, new: str) -> VersionDiff:
+        old_index, new_index = self.versions[old], self.versions[new]
+        changed = []
+        for key, fp in new_index.items():
+            old_fp = old_index.get(key)
+            if old_fp is None or old_fp == fp:
+                continue
+            old_digests, new_digests = self.digests[old_fp], self.digests[fp]
+            fields = tuple(k for k in old_digests.keys() | new_digests.keys()
+                           if old_digests.get(k) != new_digests.get(k))
+            changed.append(Change(key, tuple(sorted(fields))))
+
+        return VersionDiff(old=old, new=new,
+                           added=sorted(new_index.keys() - old_index.keys()),
+                           removed=sorted(old_index.keys() - new_index.keys()),
+                           changed=sorted(changed))
+
+    def history(self) -> list[VersionDiff]:
+        # Differences between each version and the next, in the order they were added
+        versions = list(self.versions)
+        return [self.diff(old, new) for old, new in zip(versions, versions[1:])]
+
+
+def show(diff: VersionDiff, store: BlockStore) -> None:
+    print('%s -> %s: %d added, %d removed, %d changed' % (
+        diff.old, diff.new, len(diff.added), len(diff.removed), len(diff.changed)))
+    for key in diff.added:
+        print('  + %s' % key)
+    for key in diff.removed:
+        print('  - %s' % key)
+    for change in diff.changed:
+        print('  ~ %s' % change.key)
+        old, new = store.get(diff.old, change.key), store.get(diff.new, change.key)
+        for field in change.fields:
+            print('      {:25s} {!r} -> {!r}'.format(field, old.get(field), new.get(field)))
+    print()